@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 #
 # AutoNBI.py - A tool to automate (or not) the building and modifying
 #  of Apple NetBoot NBI bundles.
@@ -7,8 +7,7 @@
 #   * OS X 10.9 Mavericks - This tool relies on parts of the SIUFoundation
 #     Framework which is part of System Image Utility, found in
 #     /System/Library/CoreServices in Mavericks.
-#
-#   * Munki tools installed at /usr/local/munki - needed for FoundationPlist.
+#   * Python 3 with PyObjC.
 #
 # Thanks to: Greg Neagle for overall inspiration and code snippets (COSXIP)
 #            Per Olofsson for the awesome AutoDMG which inspired this tool
@@ -74,27 +73,222 @@
 
 import os
 import sys
+import errno
+import hashlib
 import tempfile
-import mimetypes
-import distutils.core
 import subprocess
 import plistlib
-import optparse
+import argparse
+import atexit
 import shutil
-from distutils.version import LooseVersion
-from distutils.spawn import find_executable
-from ctypes import CDLL, Structure, c_void_p, c_size_t, c_uint, c_uint32, c_uint64, create_string_buffer, addressof, sizeof, byref
+import threading
+import mmap
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from shutil import which
+from subprocess import DEVNULL
+from ctypes import CDLL, Structure, c_void_p, c_size_t, c_uint, c_uint32, c_uint64, c_char, c_char_p, addressof, byref
 import objc
 
-sys.path.append("/usr/local/munki/munkilib")
-import FoundationPlist
+# The tools we shell out to. xz doesn't ship with OS X so look for it once
+#   here rather than walking the search path for every payload.
+HDIUTIL = '/usr/bin/hdiutil'
+XAR = '/usr/bin/xar'
+# bsdtar reads xar archives too, and unlike xar can extract to stdout
+TAR = '/usr/bin/tar'
+CPIO = '/usr/bin/cpio'
+FILECMD = '/usr/bin/file'
+NEWFS_HFS = '/sbin/newfs_hfs'
+MOUNT_HFS = '/sbin/mount_hfs'
+XZEXEC = which('xz', path='/usr/local/bin:/opt/bin:/usr/bin:/bin:/usr/sbin:/sbin')
+
+# The lzma module is optional in Python builds, Apple's among them. If it is
+#   missing decompress() falls back to driving the system liblzma through ctypes.
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
 from xml.parsers.expat import ExpatError
+import xml.etree.ElementTree as ElementTree
+
+# defusedxml's iterparse() refuses entity declarations outright, which
+#   guards the scans of plists read from images against entity expansion
+#   bombs on Pythons whose expat doesn't limit expansion itself. It's
+#   optional, plistlib refuses entity declarations on its own either way.
+try:
+    from defusedxml.ElementTree import iterparse as safeiterparse
+except ImportError:
+    safeiterparse = ElementTree.iterparse
+
+# Where sw_vers gets the host's OS version from
+SYSTEMVERSIONPLIST = '/System/Library/CoreServices/SystemVersion.plist'
 
 def _get_mac_ver():
-    import subprocess
-    p = subprocess.Popen(['sw_vers', '-productVersion'], stdout=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    return stdout.strip()
+    # Read the version sw_vers -productVersion would print straight from its
+    #   plist rather than spawning sw_vers for it
+    with open(SYSTEMVERSIONPLIST, 'rb') as plistfile:
+        return plistlib.load(plistfile)['ProductVersion']
+
+def versiontuple(version):
+    """Turns a dotted version string like '10.12.6' into (10, 12, 6) so
+        versions compare numerically."""
+    return tuple(int(part) for part in version.split('.') if part.isdigit())
+
+def readplist(path):
+    """Reads the plist at path, XML or binary"""
+    with open(path, 'rb') as plistfile:
+        return plistlib.load(plistfile)
+
+
+def checkplist(plistfile, maxdepth=64, maxdata=16*1024*1024):
+    """Scans the XML plist in the binary file object plistfile without
+        building it, raising ValueError if it nests deeper than maxdepth or
+        has a <data> element larger than maxdata. Recursive plist parsers can
+        be knocked over by either, and we read plists from disk images we
+        didn't make."""
+    # Binary plists aren't XML, nothing to scan
+    if plistfile.read(6) == b'bplist':
+        return
+    plistfile.seek(0)
+
+    depth = 0
+    try:
+        for event, elem in safeiterparse(plistfile, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth > maxdepth:
+                    raise ValueError('plist is nested deeper than %d levels' % maxdepth)
+            else:
+                depth -= 1
+                if elem.tag == 'data' and elem.text and len(elem.text) > maxdata:
+                    raise ValueError('plist has a <data> element over %d bytes' % maxdata)
+                elem.clear()
+    except ElementTree.ParseError as err:
+        raise ValueError('plist is not valid XML: %s' % err)
+
+
+def safereadplist(path, maxsize=1024*1024):
+    """Reads the plist at path after checking it with checkplist(). The file
+        is only read from disk once, both passes work on the bytes in memory.
+        Raises ValueError if it's over maxsize bytes, reading no more than
+        that."""
+    with open(path, 'rb') as plistfile:
+        data = plistfile.read(maxsize + 1)
+    if len(data) > maxsize:
+        raise ValueError('plist is over %d bytes' % maxsize)
+    checkplist(BytesIO(data))
+    return plistlib.loads(data)
+
+
+def readplistkeys(path, keys, maxdepth=64, maxsize=1024*1024):
+    """Returns a dict of the string values of keys in the top level dict of
+        the plist at path. XML plists are scanned with iterparse(), which
+        stops as soon as it has all of keys instead of building the whole
+        plist. The same limits as safereadplist() apply, ValueError is raised
+        if they're exceeded or the plist isn't valid XML."""
+    with open(path, 'rb') as plistfile:
+        if os.fstat(plistfile.fileno()).st_size > maxsize:
+            raise ValueError('plist is over %d bytes' % maxsize)
+        # Binary plists aren't XML, read those whole
+        if plistfile.read(6) == b'bplist':
+            plist = safereadplist(path, maxsize)
+            return dict((key, plist[key]) for key in keys if key in plist)
+        plistfile.seek(0)
+
+        found = {}
+        lastkey = None
+        depth = 0
+        try:
+            for event, elem in safeiterparse(plistfile, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if depth > maxdepth:
+                        raise ValueError('plist is nested deeper than %d levels' % maxdepth)
+                    continue
+                depth -= 1
+                # Direct children of the top level dict end at depth 2,
+                #   under <plist> and <dict>
+                if depth == 2:
+                    if elem.tag == 'key':
+                        lastkey = elem.text
+                    else:
+                        if elem.tag == 'string' and lastkey in keys:
+                            found[lastkey] = elem.text or ''
+                            if len(found) == len(keys):
+                                break
+                        lastkey = None
+                elem.clear()
+        except ElementTree.ParseError as err:
+            raise ValueError('plist is not valid XML: %s' % err)
+
+    return found
+
+
+def getmountpoints(plistfile):
+    """Returns the mount-point values found in the output of
+        'hdiutil attach -plist' read from the binary file object plistfile,
+        usually hdiutil's stdout. They're picked out as the XML streams past
+        instead of reading it all and building the whole plist first."""
+    mountpoints = []
+    lastkey = None
+    try:
+        for event, elem in safeiterparse(plistfile, events=('end',)):
+            if elem.tag == 'key':
+                lastkey = elem.text
+            else:
+                if elem.tag == 'string' and lastkey == 'mount-point':
+                    mountpoints.append(elem.text)
+                lastkey = None
+            elem.clear()
+    except ElementTree.ParseError:
+        # No plist, hdiutil failed and the caller reports its error
+        pass
+    except ValueError as err:
+        # defusedxml refused an entity declaration, which hdiutil never
+        #   writes itself
+        print('Error: refusing to parse hdiutil output: %s' % err, file=sys.stderr)
+
+    return mountpoints
+
+
+def runcommand(cmd, capture_output=False, env=None, cwd=None):
+    """Runs cmd to completion and returns its return code, stdout and stderr
+        as text. stdout is only kept if capture_output is True, otherwise
+        it goes to /dev/null and None is returned for it."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE if capture_output else DEVNULL,
+                            stderr=subprocess.PIPE, env=env, cwd=cwd,
+                            universal_newlines=True)
+    (output, err) = proc.communicate()
+    return proc.returncode, output, err
+
+
+def parsecmdoutput(cmd, parse=getmountpoints):
+    """Runs cmd and hands its stdout to parse as it comes in. Returns what
+        parse returns along with cmd's return code and stderr. stderr is read
+        on a thread of its own meanwhile, otherwise cmd could stall on a full
+        stderr pipe while parse waits for more stdout."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = []
+    errreader = threading.Thread(target=lambda: err.append(proc.stderr.read()))
+    errreader.start()
+    try:
+        result = parse(proc.stdout)
+    finally:
+        # Read whatever parse left behind so cmd isn't stuck writing it
+        proc.stdout.read()
+        proc.stdout.close()
+        errreader.join()
+        proc.wait()
+
+    return result, proc.returncode, b''.join(err).decode('utf-8', 'replace')
+
+
+def writeplist(plist, path):
+    """Writes plist to path as an XML plist"""
+    with open(path, 'wb') as plistfile:
+        plistlib.dump(plist, plistfile)
 
 # Setup access to the ServerInformation private framework to match board IDs to
 #   model IDs if encountered (10.11 only so far) Code by Michael Lynn. Thanks!
@@ -110,7 +304,18 @@ ServerInformation_bundle = objc.loadBundle('ServerInformation',
 #  Below code from COSXIP by Greg Neagle
 
 def cleanUp():
-    """Cleanup our TMPDIR"""
+    """Cleanup our TMPDIR, ejecting the RAM disk behind it if there is one.
+        Images are mounted with -mountRandom TMPDIR, so anything still
+        mounted in there after a failed run is detached first rather than
+        having rmtree() descend into it."""
+    global RAMDISK
+    if TMPDIR and os.path.isdir(TMPDIR):
+        for entry in os.scandir(TMPDIR):
+            if os.path.ismount(entry.path):
+                unmountdmg(entry.path)
+    if RAMDISK:
+        ejectramdisk(RAMDISK)
+        RAMDISK = None
     if TMPDIR:
         shutil.rmtree(TMPDIR, ignore_errors=True)
 
@@ -119,22 +324,64 @@ def fail(errmsg=''):
     """Print any error message to stderr,
     clean up install data, and exit"""
     if errmsg:
-        print >> sys.stderr, errmsg
+        print(errmsg, file=sys.stderr)
     cleanUp()
-    exit(1)
+    sys.exit(1)
+
+
+def removefiles(paths):
+    """Removes the files at paths, skipping any that are already gone"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
 
 
-def mountdmg(dmgpath, use_shadow=False):
+def createramdisk(sizegb, mountpoint):
+    """Creates a RAM disk of sizegb GB, formats it as HFS+ and mounts it on
+        mountpoint. Returns its device node for ejectramdisk()."""
+    # ram:// wants the size in 512 byte sectors
+    returncode, device, err = runcommand(
+        [HDIUTIL, 'attach', '-nomount', 'ram://%d' % (sizegb * 1024 * 1024 * 2)],
+        capture_output=True)
+    if returncode:
+        fail('Error: "%s" while creating a %s GB RAM disk.' % (err, sizegb))
+    device = device.strip()
+
+    for cmd in ([NEWFS_HFS, '-v', 'AutoNBI', device], [MOUNT_HFS, device, mountpoint]):
+        returncode, unused, err = runcommand(cmd)
+        if returncode:
+            ejectramdisk(device)
+            fail('Error: "%s" while setting up RAM disk %s.' % (err, device))
+
+    return device
+
+
+def ejectramdisk(device):
+    """Unmounts and detaches the RAM disk at device, discarding its contents"""
+    returncode, unused, err = runcommand([HDIUTIL, 'detach', '-force', device])
+    if returncode:
+        print('Failed to eject RAM disk %s: %s' % (device, err), file=sys.stderr)
+
+
+def mountdmg(dmgpath, use_shadow=False, readonly=False):
     """
     Attempts to mount the dmg at dmgpath
     and returns a list of mountpoints
     If use_shadow is true, mount image with shadow file
+    If readonly is true, mount it read-only
     """
     mountpoints = []
     dmgname = os.path.basename(dmgpath)
-    cmd = ['/usr/bin/hdiutil', 'attach', dmgpath,
+    # The images we attach are Apple's or our own, skip verifying their
+    #   checksums and fsck'ing their volumes
+    cmd = [HDIUTIL, 'attach', dmgpath,
            '-mountRandom', TMPDIR, '-nobrowse', '-plist',
-           '-owners', 'on']
+           '-owners', 'on', '-noverify', '-noautofsck', '-noautoopen']
+    if readonly:
+        cmd.append('-readonly')
     if use_shadow:
         shadowname = dmgname + '.shadow'
         shadowroot = os.path.dirname(dmgpath)
@@ -142,16 +389,10 @@ def mountdmg(dmgpath, use_shadow=False):
         cmd.extend(['-shadow', shadowpath])
     else:
         shadowpath = None
-    proc = subprocess.Popen(cmd, bufsize=-1,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (pliststr, err) = proc.communicate()
-    if proc.returncode:
-        print >> sys.stderr, 'Error: "%s" while mounting %s.' % (err, dmgname)
-    if pliststr:
-        plist = plistlib.readPlistFromString(pliststr)
-        for entity in plist['system-entities']:
-            if 'mount-point' in entity:
-                mountpoints.append(entity['mount-point'])
+    # Parse the plist straight off hdiutil's stdout
+    mountpoints, returncode, err = parsecmdoutput(cmd)
+    if returncode:
+        print('Error: "%s" while mounting %s.' % (err, dmgname), file=sys.stderr)
 
     return mountpoints, shadowpath
 
@@ -160,58 +401,115 @@ def unmountdmg(mountpoint):
     """
     Unmounts the dmg at mountpoint
     """
-    proc = subprocess.Popen(['/usr/bin/hdiutil', 'detach', mountpoint],
-                            bufsize=-1, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    (unused_output, err) = proc.communicate()
-    if proc.returncode:
-        print >> sys.stderr, 'Polite unmount failed: %s' % err
-        print >> sys.stderr, 'Attempting to force unmount %s' % mountpoint
+    returncode, unused_output, err = runcommand([HDIUTIL, 'detach', mountpoint])
+    if returncode:
+        print('Polite unmount failed: %s' % err, file=sys.stderr)
+        print('Attempting to force unmount %s' % mountpoint, file=sys.stderr)
         # try forcing the unmount
-        retcode = subprocess.call(['/usr/bin/hdiutil', 'detach', '-force',
-                                    mountpoint])
-        print('Unmounting successful...')
+        retcode, unused_output, err = runcommand([HDIUTIL, 'detach', '-force',
+                                                  mountpoint])
         if retcode:
-            print >> sys.stderr, 'Failed to unmount %s' % mountpoint
+            print('Failed to unmount %s: %s' % (mountpoint, err), file=sys.stderr)
+        else:
+            print('Unmounting successful...')
 
 #  Above code from COSXIP by Greg Neagle
 
-def convertdmg(dmgpath, nbishadow):
+def convertdmg(dmgpath, nbishadow=None):
     """
-    Converts the dmg at mountpoint to a .sparseimage
+    Starts converting the dmg at mountpoint to a .sparseimage in the
+    background and returns the running process along with the path of the
+    .sparseimage it writes. Pass the process to waitconvert() when done.
     """
     # Get the full path to the DMG minus the extension, hdiutil adds one
     dmgfinal = os.path.splitext(dmgpath)[0]
 
-    # Run a basic 'hdiutil convert' using the shadow file to pick up
-    #   any changes we made without needing to convert between r/o and r/w
-    cmd = ['/usr/bin/hdiutil', 'convert', dmgpath, '-format', 'UDSP',
-           '-shadow', nbishadow, '-o', dmgfinal]
-    proc = subprocess.Popen(cmd, bufsize=-1,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Run a basic 'hdiutil convert', using the shadow file if we have one to
+    #   pick up any changes we made without needing to convert between r/o
+    #   and r/w
+    cmd = [HDIUTIL, 'convert', dmgpath, '-format', 'UDSP', '-o', dmgfinal]
+    if nbishadow:
+        cmd[4:4] = ['-shadow', nbishadow]
+    proc = subprocess.Popen(cmd, stdout=DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+
+    # Return the conversion and the name of the converted DMG back to the caller
+    return proc, dmgfinal + '.sparseimage'
+
+def compactdmg(dmgpath):
+    """
+    Starts compacting the sparse image at dmgpath in the background, which
+    hands back its free space without rewriting the image like convertdmg()
+    does. Pass the process to waitconvert() when done.
+    """
+    cmd = [HDIUTIL, 'compact', dmgpath]
+    return subprocess.Popen(cmd, stdout=DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+
+def getdmgformat(dmgpath):
+    """Returns the format of the disk image at dmgpath, e.g. UDZO or UDSP"""
+    unused, output, unused_err = runcommand([HDIUTIL, 'imageinfo', '-format', dmgpath],
+                                            capture_output=True)
+    return output.strip()
+
+def isdiskimage(path):
+    """Returns True if path looks like a disk image, going by its extension
+        or else the UDIF trailer at its end"""
+    if path.lower().endswith(('.dmg', '.sparseimage', '.iso')):
+        return True
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-512, os.SEEK_END)
+            return f.read(4) == b'koly'
+    except OSError:
+        return False
+
+def waitconvert(proc):
+    """Waits for a conversion started by convertdmg() or compactdmg() to
+        finish"""
     (unused, err) = proc.communicate()
 
     # Got errors?
     if proc.returncode:
-        print >> sys.stderr, 'Disk image conversion failed: %s' % err
+        print('Disk image conversion failed: %s' % err, file=sys.stderr)
 
-    # Return the name of the converted DMG back to the caller
-    return dmgfinal + '.sparseimage'
+    return proc.returncode
+
+# The keys getosversioninfo() needs from SystemVersion.plist
+VERSIONKEYS = ('ProductUserVisibleVersion', 'ProductBuildVersion')
 
 def getosversioninfo(mountpoint):
     """"getosversioninfo will attempt to retrieve the OS X version and build
         from the given mount point by reading /S/L/CS/SystemVersion.plist
-        Most of the code comes from COSXIP without changes."""
+        Most of the code comes from COSXIP without changes. Raises an
+        Exception on errors instead of calling fail() since it may run on a
+        worker thread, the caller reports it and cleans up."""
+
+    # Sources that are a system volume themselves (like the 10.7 and 10.8
+    #   InstallESD.dmg) carry their own SystemVersion.plist, read that and
+    #   skip the BaseSystem.dmg mount and unmount round trip entirely.
+    system_version_plist = os.path.join(
+        mountpoint,
+        'System/Library/CoreServices/SystemVersion.plist')
+    if os.path.isfile(system_version_plist):
+        try:
+            version_info = readplistkeys(system_version_plist, VERSIONKEYS)
+        except (ExpatError, IOError, ValueError) as err:
+            raise Exception('Error: Could not read %s: %s' % (system_version_plist, err))
+
+        return version_info.get('ProductUserVisibleVersion'), \
+               version_info.get('ProductBuildVersion'), mountpoint
 
     # Check for availability of BaseSystem.dmg
     basesystem_dmg = os.path.join(mountpoint, 'BaseSystem.dmg')
     if not os.path.isfile(basesystem_dmg):
-        unmountdmg(mountpoint)
-        fail('Missing BaseSystem.dmg in %s' % mountpoint)
+        raise Exception('Error: Missing BaseSystem.dmg in %s' % mountpoint)
 
     # Mount BaseSystem.dmg
-    basesystemmountpoints, unused_shadowpath = mountdmg(basesystem_dmg)
-    basesystemmountpoint = basesystemmountpoints[0]
+    basesystemmountpoints, unused_shadowpath = mountdmg(basesystem_dmg, readonly=True)
+    if not basesystemmountpoints:
+        raise Exception('Error: Unable to mount %s.' % basesystem_dmg)
+    basesystemmountpoint = basesystemmountpoints[-1]
 
     # Read SystemVersion.plist from the mounted BaseSystem.dmg
     system_version_plist = os.path.join(
@@ -219,16 +517,14 @@ def getosversioninfo(mountpoint):
         'System/Library/CoreServices/SystemVersion.plist')
     # Now parse the .plist file
     try:
-        version_info = plistlib.readPlist(system_version_plist)
+        version_info = readplistkeys(system_version_plist, VERSIONKEYS)
 
     # Got errors?
-    except (ExpatError, IOError), err:
-        unmountdmg(basesystemmountpoint)
-        unmountdmg(mountpoint)
-        fail('Could not read %s: %s' % (system_version_plist, err))
+    except (ExpatError, IOError, ValueError) as err:
+        raise Exception('Error: Could not read %s: %s' % (system_version_plist, err))
 
     # Done, unmount BaseSystem.dmg
-    else:
+    finally:
         unmountdmg(basesystemmountpoint)
 
     # Return the version and build as found in the parsed plist
@@ -236,29 +532,41 @@ def getosversioninfo(mountpoint):
            version_info.get('ProductBuildVersion'), mountpoint
 
 
-def buildplist(nbiindex, nbitype, nbidescription, nbiosversion, nbiname, nbienabled, isdefault, destdir=__file__):
-    """buildplist takes a source, destination and name parameter that are used
-        to create a valid plist for imagetool ingestion."""
+def readplatformsupport(nbipath):
+    """Reads and parses PlatformSupport.plist from the NBI at nbipath, which
+        has a reasonably reliable list of model IDs and board IDs supported
+        by the OS X version being built."""
+    platformsupportplist = os.path.join(nbipath, 'i386', 'PlatformSupport.plist')
+    try:
+        return safereadplist(platformsupportplist)
+    except (ExpatError, IOError, ValueError) as err:
+        fail('Could not read %s: %s' % (platformsupportplist, err))
 
-    # Read and parse PlatformSupport.plist which has a reasonably reliable list
-    #   of model IDs and board IDs supported by the OS X version being built
+def buildplist(nbiindex, nbitype, nbidescription, nbiosversion, nbiname, nbienabled, isdefault, destdir=__file__, platformsupport=None):
+    """buildplist takes a source, destination and name parameter that are used
+        to create a valid plist for imagetool ingestion. platformsupport is
+        the parsed PlatformSupport.plist if the caller already has it."""
 
     nbipath = os.path.join(destdir, nbiname + '.nbi')
-    platformsupport = FoundationPlist.readPlist(os.path.join(nbipath, 'i386', 'PlatformSupport.plist'))
+    if platformsupport is None:
+        platformsupport = readplatformsupport(nbipath)
 
     # OS X versions prior to 10.11 list both SupportedModelProperties and
     #   SupportedBoardIds - 10.11 only lists SupportedBoardIds. So we need to
     #   check both and append to the list if missing. Basically appends any
     #   model IDs found by looking up their board IDs to 'disabledsystemidentifiers'
 
-    disabledsystemidentifiers = platformsupport.get('SupportedModelProperties') or []
-    for boardid in platformsupport.get('SupportedBoardIds') or []:
-        # Call modelPropertiesForBoardIDs from the ServerInfo framework to
-        #   look up the model ID for this board ID.
-        for sysid in ServerInformation.ServerInformationComputerModelInfo.modelPropertiesForBoardIDs_([boardid]):
+    disabledsystemidentifiers = list(platformsupport.get('SupportedModelProperties') or [])
+    boardids = platformsupport.get('SupportedBoardIds') or []
+    if boardids:
+        # Call modelPropertiesForBoardIDs from the ServerInfo framework once
+        #   to look up the model IDs for all board IDs.
+        seen = set(disabledsystemidentifiers)
+        for sysid in ServerInformation.ServerInformationComputerModelInfo.modelPropertiesForBoardIDs_(list(boardids)):
             # If the returned model ID is not yet in 'disabledsystemidentifiers'
             #   add it, but not if it's an unresolved 'Mac-*' board ID.
-            if sysid not in disabledsystemidentifiers and 'Mac-' not in sysid:
+            if sysid not in seen and 'Mac-' not in sysid:
+                seen.add(sysid)
                 disabledsystemidentifiers.append(sysid)
 
     nbimageinfo = {'IsInstall': True,
@@ -280,7 +588,7 @@ def buildplist(nbiindex, nbitype, nbidescription, nbiosversion, nbiname, nbienab
                    'osVersion': nbiosversion}
 
     plistfile = os.path.join(nbipath, 'NBImageInfo.plist')
-    FoundationPlist.writePlist(nbimageinfo, plistfile)
+    writeplist(nbimageinfo, plistfile)
 
 
 def locateinstaller(rootpath='/Applications', auto=False):
@@ -294,17 +602,17 @@ def locateinstaller(rootpath='/Applications', auto=False):
 
     # The given path doesn't exist, bail
     if not os.path.exists(rootpath):
-        print "The root path '" + rootpath + "' is not a valid path - unable " \
-                                             "to proceed."
+        print("The root path '" + rootpath + "' is not a valid path - unable " \
+                                             "to proceed.")
         sys.exit(1)
 
     # Auto mode specified but the root path is not the installer app, bail
     if auto and rootpath.endswith('com.apple.recovery.boot'):
-        print 'Source is a Recovery partition, not mounting an InstallESD...'
+        print('Source is a Recovery partition, not mounting an InstallESD...')
         return rootpath
     elif auto and not rootpath.endswith('.app'):
-        print 'Mode is auto but the rootpath is not an installer app or DMG, ' \
-              ' unable to proceed.'
+        print('Mode is auto but the rootpath is not an installer app or DMG, ' \
+              ' unable to proceed.')
         sys.exit(1)
 
     # We're auto and the root path is an app - check InstallESD.dmg is there
@@ -316,7 +624,7 @@ def locateinstaller(rootpath='/Applications', auto=False):
             print("Install source is %s" % installsource)
             return installsource
         else:
-            print 'Unable to locate InstallESD.dmg in ' + rootpath + ' - exiting.'
+            print('Unable to locate InstallESD.dmg in ' + rootpath + ' - exiting.')
             sys.exit(1)
 
     # Lastly, if we're running interactively we construct a list of possible
@@ -326,24 +634,26 @@ def locateinstaller(rootpath='/Applications', auto=False):
         installers = []
 
         # List the contents of the given root path
-        for item in os.listdir(rootpath):
+        for entry in os.scandir(rootpath):
 
-            # Look for any OS X installer apps
-            if item.startswith('Install OS X'):
+            # Look for any OS X installer apps, scandir() already knows which
+            #   entries are directories so that check costs no extra stat()
+            if entry.name.startswith('Install OS X') and entry.is_dir():
 
                 # If an potential installer app was found, look for the DMG
-                for d, p, files in os.walk(os.path.join(rootpath, item)):
-                    for file in files:
+                #   where installer apps keep it instead of walking the
+                #   whole (multi-GB) app bundle
+                installesd = os.path.join(entry.path, 'Contents/SharedSupport/InstallESD.dmg')
 
-                        # Excelsior! An InstallESD.dmg was found. Add it it
-                        #   to the installers list
-                        if file.endswith('InstallESD.dmg'):
-                            installers.append(os.path.join(rootpath, item))
+                # Excelsior! An InstallESD.dmg was found. Add it it
+                #   to the installers list
+                if os.path.isfile(installesd):
+                    installers.append(entry.path)
 
         # If the installers list has no contents no installers were found, bail
         if len(installers) == 0:
-            print 'No suitable installers found in ' + rootpath + \
-                  ' - unable to proceed.'
+            print('No suitable installers found in ' + rootpath + \
+                  ' - unable to proceed.')
             sys.exit(1)
 
         # One or more installers were found, return the list to the caller
@@ -358,17 +668,16 @@ def pickinstaller(installers):
     # Initialize choice
     choice = ''
 
-    # Cycle through the installers and print an enumerated list to stdout
-    for item in enumerate(installers):
-        print "[%d] %s" % item
+    # Print an enumerated list of the installers to stdout in one go
+    sys.stdout.write(''.join("[%d] %s\n" % item for item in enumerate(installers)))
 
     # Have the user pick an installer
     try:
-        idx = int(raw_input("Pick installer to use: "))
+        idx = int(input("Pick installer to use: "))
 
     # Got errors? Not a number, bail.
     except ValueError:
-        print "Not a valid selection - unable to proceed."
+        print("Not a valid selection - unable to proceed.")
         sys.exit(1)
 
     # Attempt to pull the installer using the user's input
@@ -377,7 +686,7 @@ def pickinstaller(installers):
 
     # Got errors? Not a valid index in the list, bail.
     except IndexError:
-        print "Not a valid selection - unable to proceed."
+        print("Not a valid selection - unable to proceed.")
         sys.exit(1)
 
     # We're done, return the user choice to the caller
@@ -406,21 +715,105 @@ def createnbi(workdir, description, osversion, name, enabled, nbiindex, nbitype,
                        'installSource': dmgmount,
                        'scriptsDebugKey': 'INFO',
                        'ownershipInfoKey': 'root:wheel'}
-    proc = subprocess.Popen(cmd, bufsize=-1, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE, env=createvariables)
+    returncode, unused, err = runcommand(cmd, env=createvariables)
 
-    (unused, err) = proc.communicate()
+    # The scripts prepworkdir() put in place have done their job either way
+    removefiles([os.path.join(workdir, 'createCommon.sh'),
+                 os.path.join(workdir, 'createVariables.sh')])
 
     # Got errors? Bail.
-    if proc.returncode:
-        print >> sys.stderr, 'Error: "%s" while processing %s.' % (err, unused)
+    if returncode:
+        print('Error: "%s" while processing %s.' % (err, buildexec), file=sys.stderr)
         sys.exit(1)
 
-    buildplist(nbiindex, nbitype, description, osversion, name, enabled, isdefault, workdir)
-
-    os.unlink(os.path.join(workdir, 'createCommon.sh'))
-    os.unlink(os.path.join(workdir, 'createVariables.sh'))
-
+    # Parse PlatformSupport.plist once here and hand it to buildplist()
+    platformsupport = readplatformsupport(destpath)
+    buildplist(nbiindex, nbitype, description, osversion, name, enabled, isdefault, workdir,
+               platformsupport=platformsupport)
+
+
+# Name of the file in a finished NBI that records what it was built from
+FINGERPRINTFILE = '.AutoNBI-fingerprint'
+
+def buildfingerprint(source, settings, customfolder=None):
+    """Returns a hash identifying an NBI built from source with settings, a
+        tuple of everything else that ends up in it. A source file is
+        identified by its size, modification time and first MB rather than
+        hashing all of it. Everything in customfolder is identified by its
+        path, size and modification time, so nothing in it is read."""
+    fingerprint = hashlib.sha256()
+    # An installer app is identified by the InstallESD.dmg inside it, the
+    #   app folder's own stat doesn't change when that's replaced
+    installesd = os.path.join(source, 'Contents/SharedSupport/InstallESD.dmg')
+    if os.path.isfile(installesd):
+        source = installesd
+    sourcestat = os.stat(source)
+    fingerprint.update(repr((sourcestat.st_size, sourcestat.st_mtime)).encode('utf-8'))
+    if os.path.isfile(source):
+        with open(source, 'rb') as sourcefile:
+            fingerprint.update(sourcefile.read(1024*1024))
+
+    if customfolder:
+        fingerprint.update(repr(customfolder).encode('utf-8'))
+        # Symlinks are followed, like the copy onto the NBI does
+        for dirpath, dirnames, filenames in os.walk(customfolder, followlinks=True):
+            # Walk in a fixed order so the same folder always hashes the same
+            dirnames.sort()
+            fingerprint.update(repr((os.path.relpath(dirpath, customfolder), dirnames)).encode('utf-8'))
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                filestat = os.stat(filepath)
+                fingerprint.update(repr((os.path.relpath(filepath, customfolder),
+                                         filestat.st_size, filestat.st_mtime_ns)).encode('utf-8'))
+
+    fingerprint.update(repr(settings).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+def readfingerprint(nbipath):
+    """Returns the fingerprint recorded in the NBI at nbipath, or None if it
+        has none"""
+    try:
+        with open(os.path.join(nbipath, FINGERPRINTFILE)) as fingerprintfile:
+            return fingerprintfile.read().strip()
+    except IOError:
+        return None
+
+def writefingerprint(nbipath, fingerprint):
+    """Records fingerprint in the NBI at nbipath, or removes the record if
+        fingerprint is None"""
+    fingerprintpath = os.path.join(nbipath, FINGERPRINTFILE)
+    if fingerprint is None:
+        removefiles([fingerprintpath])
+    else:
+        with open(fingerprintpath, 'w') as fingerprintfile:
+            fingerprintfile.write(fingerprint + '\n')
+
+
+# clonefile(2) makes a copy-on-write clone on APFS, so no data is copied
+#   until either side is modified. It's in libSystem on 10.12+.
+try:
+    _clonefile = CDLL('/usr/lib/libSystem.B.dylib', use_errno=True).clonefile
+    _clonefile.argtypes = [c_char_p, c_char_p, c_uint32]
+except (OSError, AttributeError):
+    _clonefile = None
+
+def fastcopy(source, target):
+    """Copies source to target, cloning it if the volume supports that and
+        falling back to a plain copy otherwise. A clone is a separate file,
+        so either side can be modified without touching the other."""
+    if (_clonefile is not None and
+            _clonefile(os.fsencode(source), os.fsencode(target), 0) == 0):
+        return
+    shutil.copy2(source, target)
+
+def copytree(source, target):
+    """Recursively copies the folder source to target, which must not exist
+        yet. If both are on the same volume files are cloned with fastcopy()
+        instead of copied. Symlinks are followed."""
+    samevolume = (os.stat(source).st_dev ==
+                  os.stat(os.path.dirname(os.path.abspath(target))).st_dev)
+    shutil.copytree(source, target,
+                    copy_function=fastcopy if samevolume else shutil.copy2)
 
 def prepworkdir(workdir):
     """Copies in the required Apple-provided createCommon.sh and also creates
@@ -431,7 +824,7 @@ def prepworkdir(workdir):
     commonsource = os.path.join(BUILDEXECPATH, 'createCommon.sh')
     commontarget = os.path.join(workdir, 'createCommon.sh')
 
-    shutil.copyfile(commonsource, commontarget)
+    fastcopy(commonsource, commontarget)
     open(os.path.join(workdir, 'createVariables.sh'), 'a').close()
 
     if isHighSierra:
@@ -440,12 +833,27 @@ def prepworkdir(workdir):
         enterprisedict['SIU-SKEL-setting'] = False
         enterprisedict['SIU-teamIDs-to-add'] = []
 
-        plistlib.writePlist(enterprisedict, os.path.join(workdir, '.SIUSettings'))
+        writeplist(enterprisedict, os.path.join(workdir, '.SIUSettings'))
 
 # Example usage of the function:
 # decompress('PayloadJava.cpio.xz', 'PayloadJava.cpio')
 # Decompresses a xz compressed file from the first input file path to the second output file path
 
+def decompress(infile, outfile):
+    # Let the lzma module's C layer own the buffers and the decode loop, we
+    #   only shuttle 1 MB blocks between the two files.
+    if lzma is None:
+        return liblzmadecompress(infile, outfile)
+
+    with lzma.open(infile, 'rb') as fin:
+        with open(outfile, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, 1024*1024)
+
+    return True
+
+# Everything below is only used when no lzma module is available, in which
+#   case we talk to liblzma directly.
+
 class lzma_stream(Structure):
     _fields_ = [
         ("next_in",        c_void_p),
@@ -471,7 +879,8 @@ class lzma_stream(Structure):
 # Hardcoded this path to the System liblzma dylib location, so that /usr/local/lib or other user
 # installed library locations aren't used (which ctypes.util.find_library(...) would hit).
 # Available in OS X 10.7+
-c_liblzma = CDLL('/usr/lib/liblzma.dylib')
+if lzma is None:
+    c_liblzma = CDLL('/usr/lib/liblzma.dylib')
 
 NULL               = None
 BUFSIZ             = 65535
@@ -479,93 +888,103 @@ LZMA_OK            = 0
 LZMA_RUN           = 0
 LZMA_FINISH        = 3
 LZMA_STREAM_END    = 1
-BLANK_BUF          = '\x00'*BUFSIZ
 UINT64_MAX         = c_uint64(18446744073709551615)
 LZMA_CONCATENATED  = c_uint32(0x08)
 LZMA_RESERVED_ENUM = 0
-LZMA_STREAM_INIT   = [NULL, 0, 0, NULL, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, 0, 0, 0, 0, LZMA_RESERVED_ENUM, LZMA_RESERVED_ENUM]
-
-def decompress(infile, outfile):
+LZMA_STREAM_INIT   = (NULL, 0, 0, NULL, 0, 0, NULL, NULL, NULL, NULL, NULL, NULL, 0, 0, 0, 0, LZMA_RESERVED_ENUM, LZMA_RESERVED_ENUM)
+
+# Input/output buffers for liblzmadecompress(), allocated once and reused
+#   for every part. Parts get decompressed in parallel so each thread gets
+#   its own pair.
+_lzmabuffers = threading.local()
+
+def getlzmabuffers():
+    if not hasattr(_lzmabuffers, 'inbuf'):
+        # bytearrays that liblzma reads from and writes into directly
+        #   through ctypes views, so they can be handed to readinto() and
+        #   write() without a copy
+        _lzmabuffers.inbuf = bytearray(BUFSIZ)
+        _lzmabuffers.inbuf_c = (c_char * BUFSIZ).from_buffer(_lzmabuffers.inbuf)
+        _lzmabuffers.outbuf = bytearray(BUFSIZ)
+        _lzmabuffers.outbuf_c = (c_char * BUFSIZ).from_buffer(_lzmabuffers.outbuf)
+    return (_lzmabuffers.inbuf, _lzmabuffers.inbuf_c,
+            _lzmabuffers.outbuf, _lzmabuffers.outbuf_c)
+
+def liblzmadecompress(infile, outfile):
     # Create an empty lzma_stream object
     strm = lzma_stream(*LZMA_STREAM_INIT)
+    strm_ref = byref(strm)
 
     # Initialize a decoder
-    result = c_liblzma.lzma_stream_decoder(byref(strm), UINT64_MAX, LZMA_CONCATENATED)
-
-    # Setup the output buffer
-    outbuf = create_string_buffer(BUFSIZ)
-    strm.next_out  = addressof(outbuf)
-    strm.avail_out = sizeof(outbuf)
-
-    # Setup the (blank) input buffer
-    inbuf  = create_string_buffer(BUFSIZ)
-    strm.next_in = addressof(inbuf)
-    strm.avail_in = 0
-
-    # Read in the input .xz file
-    # ... Not the best way to do things because it reads in the entire file - probably not great for GB+ size
-
-    # f_in = open(infile, 'rb')
-    # xz_file = f_in.read()
-    # f_in.close()
-    xz_file = open(infile, 'rb')
-
-    cursor = 0
-    xz_file.seek(0,2)
-    EOF = xz_file.tell()
-    xz_file.seek(0)
-
-    # Open up our output file
-    f_out = open(outfile, 'wb')
-
-    # Start with a RUN action
-    action = LZMA_RUN
-    # Keep looping while we're processing
-    while True:
-        # Check if decoder has consumed the current input buffer and we have remaining data
-        if ((strm.avail_in == 0) and (cursor < EOF)):
-            # Load more data!
-            # In theory, I shouldn't have to clear the input buffer, but I'm paranoid
-            # inbuf[:] = BLANK_BUF
-            # Now we load it:
-            # - Attempt to take a BUFSIZ chunk of data
-            input_chunk = xz_file.read(BUFSIZ)
-            # - Measure how much we actually got
-            input_len   = len(input_chunk)
-            # - Assign the data to the buffer
-            inbuf[0:input_len] = input_chunk
-            # - Configure our chunk input information
-            strm.next_in  = addressof(inbuf)
-            strm.avail_in = input_len
-            # - Adjust our cursor
-            cursor += input_len
-            # - If the cursor is at the end, switch to FINISH action
-            if (cursor >= EOF):
-                action = LZMA_FINISH
-        # If we're here, we haven't completed/failed, so process more data!
-        result = c_liblzma.lzma_code(byref(strm), action)
-        # Check if we filled up the output buffer / completed running
-        if ((strm.avail_out == 0) or (result == LZMA_STREAM_END)):
-            # Write out what data we have!
-            # - Measure how much we got
-            output_len   = BUFSIZ - strm.avail_out
-            # - Get that much from the buffer
-            output_chunk = outbuf.raw[:output_len]
-            # - Write it out
-            f_out.write(output_chunk)
-            # - Reset output information to a full available buffer
-            # (Intentionally not clearing the output buffer here .. but probably could?)
-            strm.next_out  = addressof(outbuf)
-            strm.avail_out = sizeof(outbuf)
-        if (result != LZMA_OK):
-            if (result == LZMA_STREAM_END):
-                # Yay, we finished
-                result = c_liblzma.lzma_end(byref(strm))
-                return True
-            # If we got here, we have a problem
-            # Error codes are defined in xz/src/liblzma/api/lzma/base.h (LZMA_MEM_ERROR, etc.)
-            # Implementation of pretty English error messages is an exercise left to the reader ;)
-            raise Exception("Error: return code of value %s - naive decoder couldn't handle input!" % (result))
+    result = c_liblzma.lzma_stream_decoder(strm_ref, UINT64_MAX, LZMA_CONCATENATED)
+
+    # The loop below only ever touches these four fields. Map plain ctypes
+    #   views straight onto them once rather than going through the
+    #   Structure's field descriptors on every pass.
+    strm_addr = addressof(strm)
+    next_in   = c_void_p.from_address(strm_addr + lzma_stream.next_in.offset)
+    avail_in  = c_size_t.from_address(strm_addr + lzma_stream.avail_in.offset)
+    next_out  = c_void_p.from_address(strm_addr + lzma_stream.next_out.offset)
+    avail_out = c_size_t.from_address(strm_addr + lzma_stream.avail_out.offset)
+    lzma_code = c_liblzma.lzma_code
+
+    # Setup the output buffer and the (blank) input buffer
+    inbuf, inbuf_c, outbuf, outbuf_c = getlzmabuffers()
+    inbuf_addr  = addressof(inbuf_c)
+    outbuf_addr = addressof(outbuf_c)
+    outbuf_view = memoryview(outbuf)
+    next_out.value  = outbuf_addr
+    avail_out.value = BUFSIZ
+
+    next_in.value  = inbuf_addr
+    avail_in.value = 0
+
+    # Open up our input .xz and output files, reading the input BUFSIZ at a
+    #   time rather than all at once since it can easily be GB+ in size.
+    with open(infile, 'rb') as xz_file, open(outfile, 'wb') as f_out:
+
+        # Start with a RUN action
+        action = LZMA_RUN
+        # Keep looping while we're processing
+        while True:
+            # Check if decoder has consumed the current input buffer and we have remaining data
+            if ((avail_in.value == 0) and (action == LZMA_RUN)):
+                # Load more data!
+                # - Attempt to read a BUFSIZ chunk of data straight into the buffer
+                input_len = xz_file.readinto(inbuf)
+                # - Nothing left to read, switch to FINISH action
+                if not input_len:
+                    action = LZMA_FINISH
+                else:
+                    # - Configure our chunk input information
+                    next_in.value  = inbuf_addr
+                    avail_in.value = input_len
+                    # - A short read means we hit the end of the file, switch to FINISH action
+                    if (input_len < BUFSIZ):
+                        action = LZMA_FINISH
+            # If we're here, we haven't completed/failed, so process more data!
+            result = lzma_code(strm_ref, action)
+            # Check if we filled up the output buffer / completed running
+            if ((avail_out.value == 0) or (result == LZMA_STREAM_END)):
+                # Write out what data we have!
+                # - Measure how much we got
+                output_len   = BUFSIZ - avail_out.value
+                # - Write that much out straight from the buffer
+                f_out.write(outbuf_view[:output_len])
+                # - Reset output information to a full available buffer
+                # (Intentionally not clearing the output buffer here .. but probably could?)
+                next_out.value  = outbuf_addr
+                avail_out.value = BUFSIZ
+            if (result != LZMA_OK):
+                if (result == LZMA_STREAM_END):
+                    # Yay, we finished
+                    result = c_liblzma.lzma_end(strm_ref)
+                    return True
+                # If we got here, we have a problem
+                # Error codes are defined in xz/src/liblzma/api/lzma/base.h (LZMA_MEM_ERROR, etc.)
+                # Implementation of pretty English error messages is an exercise left to the reader ;)
+                c_liblzma.lzma_end(strm_ref)
+                raise Exception("Error: return code of value %s - naive decoder couldn't handle input!" % (result))
 
 
 class processNBI(object):
@@ -580,13 +999,37 @@ class processNBI(object):
          self.enablepython = enablepython
          self.enableruby = enableruby
          self.utilplist = utilplist
-         self.hdiutil = '/usr/bin/hdiutil'
+         self.hdiutil = HDIUTIL
+         self.pending = []
+         self.workers = []
+         # Set once any step reports an error, most of them only print it
+         #   and carry on
+         self.failed = False
 
 
     # Make the provided NetInstall.dmg r/w by mounting it with a shadow file
     def makerw(self, netinstallpath):
-        # Call mountdmg() with the use_shadow option set to True
-        nbimount, nbishadow = mountdmg(netinstallpath, use_shadow=True)
+        # A sparse image, like the NetInstall.dmg of an NBI we built before,
+        #   is writable as-is and only needs compacting when we're done.
+        #   Anything else gets converted to a sparse image up front so our
+        #   changes are written straight to it instead of going through a
+        #   shadow file first.
+        issparse = getdmgformat(netinstallpath) == 'UDSP'
+        if not issparse:
+            convertproc, sparsepath = convertdmg(netinstallpath)
+            if not waitconvert(convertproc):
+                os.remove(netinstallpath)
+                os.rename(sparsepath, netinstallpath)
+                issparse = True
+            else:
+                # Don't leave a partial sparse image behind in the NBI
+                removefiles([sparsepath])
+
+        if issparse:
+            nbimount, nbishadow = mountdmg(netinstallpath)
+        else:
+            # The conversion failed, fall back to mounting with a shadow file
+            nbimount, nbishadow = mountdmg(netinstallpath, use_shadow=True)
 
         # Send the mountpoint and shadow file back to the caller
         return nbimount[0], nbishadow
@@ -602,7 +1045,16 @@ class processNBI(object):
                                '-nobrowse',
                                '-plist',
                                '-owners', 'on',
+                               '-noverify',
+                               '-noautofsck',
+                               '-noautoopen',
                                attach_source ]
+    def attach(self, attach_source, shadow_file):
+        # Attach attach_source with shadow_file and return its mount point.
+        #   The volume we're after is the last entity with a mount point.
+        mountpoints = self.runcmdplist(self.dmgattach(attach_source, shadow_file))
+        return mountpoints[-1] if mountpoints else None
+
     def dmgdetach(self, detach_mountpoint):
         return [ self.hdiutil, 'detach', '-force',
                           detach_mountpoint ]
@@ -623,7 +1075,7 @@ class processNBI(object):
 
     def dmgresize(self, resize_source, shadow_file=None, size=None):
 
-        print "Will resize DMG at mount: %s" % resize_source
+        print("Will resize DMG at mount: %s" % resize_source)
 
         if shadow_file:
             return [ self.hdiutil, 'resize',
@@ -631,61 +1083,77 @@ class processNBI(object):
                           '-shadow', shadow_file,
                           resize_source ]
         else:
-            proc = subprocess.Popen(['/usr/bin/hdiutil', 'resize', '-limits', resize_source],
-                                      bufsize=-1, stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE)
-
-            (output, err) = proc.communicate()
+            returncode, output, err = runcommand([self.hdiutil, 'resize', '-limits', resize_source],
+                                                 capture_output=True)
+            if returncode:
+                print('Error "%s" while reading the size limits of %s' % (err, resize_source), file=sys.stderr)
+                self.failed = True
 
             size = output.split('\t')[0]
 
             return [ self.hdiutil, 'resize',
                           '-size', '%sb' % size, resize_source ]
 
-    def xarextract(self, xar_source, sysplatform):
+    def xarextract(self, xar_source, sysplatform, destdir=None):
 
         if 'darwin' in sysplatform:
-            return [ '/usr/bin/xar', '-x',
+            return [ XAR, '-x',
                                      '-f', xar_source,
                                      'Payload',
-                                     '-C', TMPDIR ]
+                                     '-C', destdir or TMPDIR ]
         else:
             # TO-DO: decompress xz lzma with Python
             pass
-    def cpioextract(self, cpio_archive, pattern):
-        return [ '/usr/bin/cpio -idmu --quiet -I %s %s' % (cpio_archive, pattern) ]
-    def xzextract(self, xzexec, xzfile):
-        return ['%s -d %s' % (xzexec, xzfile)]
+    def cpioextract(self, cpio_archive, patterns):
+        return [ CPIO, '-idmu', '--quiet', '-I', cpio_archive ] + patterns
     def getfiletype(self, filepath):
-        return ['/usr/bin/file', filepath]
+        return [FILECMD, filepath]
 
-    def runcmd(self, cmd, cwd=None):
+    def runcmd(self, cmd, cwd=None, capture_output=True):
 
         # print cmd
 
-        if type(cwd) is not str:
-            proc = subprocess.Popen(cmd, bufsize=-1,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (result, err) = proc.communicate()
-        else:
-            proc = subprocess.Popen(cmd, bufsize=-1,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd,
-                            shell=True)
-            (result, err) = proc.communicate()
+        # Only hold on to stdout if the caller wants it, some of these
+        #   commands are chatty
+        returncode, result, err = runcommand(cmd, capture_output=capture_output, cwd=cwd)
 
-        if proc.returncode:
-            print >> sys.stderr, 'Error "%s" while running command %s' % (err, cmd)
+        if returncode:
+            print('Error "%s" while running command %s' % (err, cmd), file=sys.stderr)
+            self.failed = True
+
+        return result
+
+    def runcmdplist(self, cmd, parse=getmountpoints):
+
+        # Like runcmd() but hand cmd's stdout straight to parse, which reads
+        #   the plist from it as it comes in, and return what parse returns.
+        #   stdout is a pipe, so parse can't seek; plistlib.load() does.
+        result, returncode, err = parsecmdoutput(cmd, parse)
+
+        if returncode:
+            print('Error "%s" while running command %s' % (err, cmd), file=sys.stderr)
+            self.failed = True
 
         return result
 
     # Code for parse_pbzx from https://gist.github.com/pudquick/ff412bcb29c9c1fa4b8d
     # Further write-up: https://gist.github.com/pudquick/29fcfe09c326a9b96cf5
-    def seekread(self, f, offset=None, length=0, relative=True):
-        if (offset != None):
-            # offset provided, let's seek
-            f.seek(offset, [0,1,2][relative])
-        if (length != 0):
-            return f.read(length)
+    def copyrange(self, f, out, length):
+        # Copy length bytes from the current position in f to out in 1 MB
+        #   pieces. f is a pipe, so this reads strictly front to back.
+        copied = 0
+        while copied < length:
+            data = f.read(min(1024*1024, length - copied))
+            if not data:
+                break
+            out.write(data)
+            copied += len(data)
+
+    def waitxz(self, xz_proc):
+        # Close xz's stdin so it flushes what's left of its output and exits
+        xz_proc.stdin.close()
+        if xz_proc.wait():
+            raise Exception("Error: xz exited with return code %s while unwrapping pbzx" % xz_proc.returncode)
 
     def parse_pbzx(self, pbzx_path):
         import struct
@@ -693,101 +1161,243 @@ class processNBI(object):
         archivechunks = []
         section = 0
         xar_out_path = '%s.part%02d.cpio.xz' % (pbzx_path, section)
-        f = open(pbzx_path, 'rb')
-        # pbzx = f.read()
-        # f.close()
-        magic = self.seekread(f,length=4)
-        if magic != 'pbzx':
-            raise "Error: Not a pbzx file"
+        with open(pbzx_path, 'rb') as f:
+            magic = f.read(4)
+            if magic != b'pbzx':
+                raise Exception("Error: Not a pbzx file")
+            # Map the whole payload and walk it by offset, the sections are
+            #   written straight out of the mapping without reading them in
+            #   first.
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as pbzx:
+                # Read 8 bytes for initial flags, a 64-bit big-endian unsigned int
+                flags = struct.unpack_from('>Q', pbzx, 4)[0]
+                offset = 12
+                xar_f = open(xar_out_path, 'wb')
+                archivechunks.append(xar_out_path)
+                try:
+                    while (flags & (1 << 24)):
+                        # Read in more flags, and the length of this section
+                        flags, f_length = struct.unpack_from('>QQ', pbzx, offset)
+                        offset += 16
+                        with memoryview(pbzx)[offset:offset + f_length] as chunk:
+                            if len(chunk) != f_length:
+                                raise Exception("Error: pbzx section is truncated")
+                            if chunk[:6] != b'\xfd7zXZ\x00':
+                                # This isn't xz content, this is actually _raw decompressed cpio_ chunk of 16MB in size...
+                                # ... so split it out ...
+                                section += 1
+                                decomp_out = '%s.part%02d.cpio' % (pbzx_path, section)
+                                with open(decomp_out, 'wb') as g:
+                                    g.write(chunk)
+                                archivechunks.append(decomp_out)
+                                # Now to start the next section, which should hopefully be .xz (we'll just assume it is ...)
+                                xar_f.close()
+                                section += 1
+                                new_out = '%s.part%02d.cpio.xz' % (pbzx_path, section)
+                                xar_f = open(new_out, 'wb')
+                                archivechunks.append(new_out)
+                            else:
+                                # This part needs to be written out
+                                xar_f.write(chunk)
+                                if chunk[-2:] != b'YZ':
+                                    raise Exception("Error: Footer is not xar file footer")
+                        offset += f_length
+                finally:
+                    xar_f.close()
+
+        return archivechunks
+
+    def unwrappbzx(self, f, out):
+        # Unwrap the pbzx stream in f, positioned just past its 'pbzx' magic,
+        #   into out: xz sections are decompressed with the lzma module, or
+        #   piped through 'xz -d' without it, and raw sections are copied
+        #   over as-is. Unlike parse_pbzx() this reads f strictly front to
+        #   back, so f can be a pipe.
+        import struct
+
+        xz_proc = None
         # Read 8 bytes for initial flags
-        flags = self.seekread(f,length=8)
-        # Interpret the flags as a 64-bit big-endian unsigned int
-        flags = struct.unpack('>Q', flags)[0]
-        xar_f = open(xar_out_path, 'wb')
-        archivechunks.append(xar_out_path)
+        flags = struct.unpack('>Q', f.read(8))[0]
         while (flags & (1 << 24)):
-            # Read in more flags
-            flags = self.seekread(f,length=8)
-            flags = struct.unpack('>Q', flags)[0]
-            # Read in length
-            f_length = self.seekread(f,length=8)
-            f_length = struct.unpack('>Q', f_length)[0]
-            xzmagic = self.seekread(f,length=6)
-            if xzmagic != '\xfd7zXZ\x00':
-                # This isn't xz content, this is actually _raw decompressed cpio_ chunk of 16MB in size...
-                # Let's back up ...
-                self.seekread(f,offset=-6,length=0)
-                # ... and split it out ...
-                f_content = self.seekread(f,length=f_length)
-                section += 1
-                decomp_out = '%s.part%02d.cpio' % (pbzx_path, section)
-                g = open(decomp_out, 'wb')
-                g.write(f_content)
-                g.close()
-                archivechunks.append(decomp_out)
-                # Now to start the next section, which should hopefully be .xz (we'll just assume it is ...)
-                xar_f.close()
-                section += 1
-                new_out = '%s.part%02d.cpio.xz' % (pbzx_path, section)
-                xar_f = open(new_out, 'wb')
-                archivechunks.append(new_out)
+            # Read in more flags, and the length of this section
+            flags, f_length = struct.unpack('>QQ', f.read(16))
+            head = f.read(min(6, f_length))
+            if head != b'\xfd7zXZ\x00':
+                # A raw cpio section. Let xz finish writing out the preceding
+                #   sections first so this lands after them.
+                if xz_proc:
+                    self.waitxz(xz_proc)
+                    xz_proc = None
+                out.write(head)
+                self.copyrange(f, out, f_length - len(head))
+            elif lzma is not None:
+                # Each xz section is a complete xz stream, feed it through a
+                #   decompressor of its own in 1 MB pieces
+                decompressor = lzma.LZMADecompressor()
+                out.write(decompressor.decompress(head))
+                remaining = f_length - 8
+                while remaining > 0:
+                    data = f.read(min(1024*1024, remaining))
+                    if not data:
+                        break
+                    out.write(decompressor.decompress(data))
+                    remaining -= len(data)
+                tail = f.read(2)
+                out.write(decompressor.decompress(tail))
+                if tail != b'YZ' or not decompressor.eof:
+                    raise Exception("Error: Footer is not xar file footer")
             else:
-                f_length -= 6
-                # This part needs buffering
-                f_content = self.seekread(f,length=f_length)
-                tail = self.seekread(f,offset=-2,length=2)
-                xar_f.write(xzmagic)
-                xar_f.write(f_content)
-                if tail != 'YZ':
-                    xar_f.close()
-                    raise "Error: Footer is not xar file footer"
-
+                if not xz_proc:
+                    # Flush anything we wrote ourselves before xz starts
+                    #   writing to the same file
+                    out.flush()
+                    xz_proc = subprocess.Popen([XZEXEC, '--decompress', '--stdout'],
+                                               bufsize=1024*1024, stdin=subprocess.PIPE, stdout=out)
+                xz_proc.stdin.write(head)
+                self.copyrange(f, xz_proc.stdin, f_length - 8)
+                tail = f.read(2)
+                xz_proc.stdin.write(tail)
+                if tail != b'YZ':
+                    raise Exception("Error: Footer is not xar file footer")
+
+        if xz_proc:
+            self.waitxz(xz_proc)
+
+    def streampayload(self, xar_source, patterns, cwd):
+        # Stream the Payload of the package at xar_source into cpio without
+        #   writing any of it to disk. bsdtar reads it out of the xar archive,
+        #   pbzx-wrapped payloads are unwrapped on the way through.
+        print("Streaming Payload from %s" % xar_source)
+        tar_proc = subprocess.Popen([TAR, '-xOf', xar_source, 'Payload'],
+                                    bufsize=1024*1024, stdout=subprocess.PIPE)
+        cpio_proc = subprocess.Popen([CPIO, '-idmu', '--quiet'] + patterns,
+                                     bufsize=1024*1024, stdin=subprocess.PIPE, stdout=DEVNULL,
+                                     stderr=subprocess.PIPE, cwd=cwd)
+        # Collect cpio's complaints on a thread of their own so it can't
+        #   stall on a full stderr pipe while we're feeding it
+        cpioerr = []
+        errreader = threading.Thread(target=lambda: cpioerr.append(cpio_proc.stderr.read()))
+        errreader.start()
+        brokenpipe = False
+        failure = None
         try:
-            f.close()
-            xar_f.close()
-        except:
-            pass
-
-        return archivechunks
+            magic = tar_proc.stdout.read(4)
+            if magic == b'pbzx':
+                self.unwrappbzx(tar_proc.stdout, cpio_proc.stdin)
+            else:
+                # Older payloads are plain gzipped cpio, which cpio reads as-is
+                cpio_proc.stdin.write(magic)
+                shutil.copyfileobj(tar_proc.stdout, cpio_proc.stdin, 1024*1024)
+        except BrokenPipeError:
+            # cpio stopped reading, its return code and stderr below say why
+            brokenpipe = True
+        except Exception as err:
+            # Likewise an xz that died writing to a cpio that went away,
+            #   raised below unless cpio failing explains it
+            failure = err
+        finally:
+            # Closing our end of tar's stdout stops it if we bailed early
+            tar_proc.stdout.close()
+            tar_proc.wait()
+            try:
+                cpio_proc.stdin.close()
+            except BrokenPipeError:
+                brokenpipe = True
+            cpio_proc.wait()
+            errreader.join()
+        if cpio_proc.returncode:
+            raise Exception("Error: cpio exited with return code %s while extracting %s: %s" %
+                            (cpio_proc.returncode, xar_source,
+                             b''.join(cpioerr).decode('utf-8', 'replace').strip()))
+        if failure:
+            raise failure
+        # cpio stops reading at the end of the archive, which can leave tar
+        #   writing padding into a closed pipe. That's not an error.
+        if tar_proc.returncode and not brokenpipe:
+            raise Exception("Error: tar exited with return code %s while reading %s" % (tar_proc.returncode, xar_source))
+
+    def decompresschunk(self, xzfile):
+        # Decompress an .xz part next to itself, minus the .xz extension
+        print('Decompressing %s' % xzfile)
+        decompress(xzfile, xzfile[:-3])
+        os.remove(xzfile)
+
+    def fetchpayload(self, installersource, payload):
+        # Extract the Payload from payload.pkg into a directory of its own,
+        #   so several packages can be fetched at once, and process it into
+        #   a cached archive for cpio. Returns the path of that archive.
+        xar_source = os.path.join(installersource, 'Packages', payload + '.pkg')
+        payloaddir = os.path.join(TMPDIR, payload)
+        payloadsource = os.path.join(payloaddir, 'Payload')
+        cpio_archive = os.path.join(TMPDIR, 'Payload-' + payload + '.cpio.xz')
+        os.mkdir(payloaddir)
+
+        print("Extracting %s" % xar_source)
+
+        # Extract Payload(s) from desired OS X installer package
+        sysplatform = sys.platform
+        self.runcmd(self.xarextract(xar_source, sysplatform, payloaddir), capture_output=False)
+
+        # Determine the Payload file type using 'file'
+        payloadtype = self.runcmd(self.getfiletype(payloadsource)).split(': ')[1]
+
+        print("Processing payloadsource %s" % payloadsource)
+        self.processframeworkpayload(payloadsource, payloadtype, cpio_archive)
+        shutil.rmtree(payloaddir, ignore_errors=True)
+
+        return cpio_archive
 
     def processframeworkpayload(self, payloadsource, payloadtype, cpio_archive):
         # Check filetype of the Payload, 10.10 adds a pbzx wrapper
         if payloadtype.startswith('data'):
-            # This is most likely pbzx-wrapped, unwrap it
+            # This is most likely pbzx-wrapped, unwrap it into xz chunks to
+            #   decompress below
             print("Payload %s is PBZX-wrapped, unwrapping..." % payloadsource)
             chunks = self.parse_pbzx(payloadsource)
             os.remove(payloadsource)
-            fout = file(os.path.join(TMPDIR, cpio_archive), 'wb')
 
+            # Work out which xz parts need decompressing in place, and the
+            #   list of raw cpio parts that leaves us with
+            xzchunks = []
+            cpiochunks = []
             for xzfile in chunks:
-                if '.xz' in xzfile and os.path.getsize(xzfile) > 0:
-                    print('Decompressing %s' % xzfile)
-
-                    xzexec = find_executable('xz', '/usr/local/bin:/opt/bin:/usr/bin:/bin:/usr/sbin:/sbin')
-
-                    if xzexec is not None:
-                        print("Found xz executable at %s..." % xzexec)
-                        result = self.runcmd(self.xzextract(xzexec, xzfile), cwd=TMPDIR)
-                    else:
-                        print("No xz executable found, using decompress()")
-                        result = decompress(xzfile, xzfile.strip('.xz'))
+                if xzfile.endswith('.xz'):
+                    # A raw chunk at the very end of the pbzx leaves an empty
+                    #   .xz part behind, skip it
+                    if os.path.getsize(xzfile) == 0:
                         os.remove(xzfile)
-
-                    fin = file(xzfile.strip('.xz'), 'rb')
-                    print("-------------------------------------------------------------------------")
-                    print("Concatenating %s" % cpio_archive)
-                    shutil.copyfileobj(fin, fout, 65536)
-                    fin.close()
-                    os.remove(fin.name)
+                        continue
+                    xzchunks.append(xzfile)
+                    cpiochunks.append(xzfile[:-3])
                 else:
-                    fin = file(xzfile, 'rb')
-                    print("-------------------------------------------------------------------------")
-                    print("Concatenating %s" % cpio_archive)
-                    shutil.copyfileobj(fin, fout, 65536)
-                    fin.close()
-                    os.remove(fin.name)
+                    cpiochunks.append(xzfile)
+
+            # The xz parts don't depend on each other, so decompress them in
+            #   parallel. Both xz and liblzma do their work outside the GIL
+            #   so threads are enough to keep all cores busy.
+            if xzchunks:
+                if lzma is not None:
+                    print("Decompressing xz parts with the lzma module")
+                else:
+                    print("Decompressing xz parts with liblzma")
+                with ThreadPoolExecutor(min(len(xzchunks), cpu_count())) as pool:
+                    list(pool.map(self.decompresschunk, xzchunks))
+
+            cpio_archive = os.path.join(TMPDIR, cpio_archive)
+            print("-------------------------------------------------------------------------")
 
-            fout.close()
+            if len(cpiochunks) == 1:
+                # Only one part, which is the cpio archive as-is. Move it into
+                #   place instead of copying it over.
+                print("Renaming %s to %s" % (cpiochunks[0], cpio_archive))
+                os.rename(cpiochunks[0], cpio_archive)
+            else:
+                print("Concatenating %s" % cpio_archive)
+                with open(cpio_archive, 'wb') as fout:
+                    for cpiochunk in cpiochunks:
+                        with open(cpiochunk, 'rb') as fin:
+                            shutil.copyfileobj(fin, fout, 1024*1024)
+                        os.remove(cpiochunk)
 
         else:
             # No pbzx wrapper, rename and move to cpio extraction
@@ -809,33 +1419,63 @@ class processNBI(object):
             # In High Sierra pretty much everything is in Core. New name. Same contents.
             # We also need to add libssl as it's no longer standard.
             payloads = { 'python': {'sourcepayloads': ['Core'],
-                                    'regex': '\"*Py*\" \"*py*\" \"*/etc/ssl/*\" \"*libssl*\" \"*libcrypto*\" \"*libffi.dylib*\" \"*libexpat*\"'},
+                                    'patterns': ['*Py*', '*py*', '*/etc/ssl/*', '*libssl*', '*libcrypto*', '*libffi.dylib*', '*libexpat*']},
                          'ruby': {'sourcepayloads': ['Core'],
-                                  'regex': '\"*ruby*\" \"*lib*ruby*\" \"*Ruby.framework*\"  \"*libssl*\"'}
+                                  'patterns': ['*ruby*', '*lib*ruby*', '*Ruby.framework*', '*libssl*']}
                        }
 
         elif isSierra:
             # In Sierra pretty much everything is in Essentials.
             # We also need to add libssl as it's no longer standard.
             payloads = { 'python': {'sourcepayloads': ['Essentials'],
-                                    'regex': '\"*Py*\" \"*py*\" \"*libssl*\" \"*libffi.dylib*\" \"*libexpat*\"'},
+                                    'patterns': ['*Py*', '*py*', '*libssl*', '*libffi.dylib*', '*libexpat*']},
                          'ruby': {'sourcepayloads': ['Essentials'],
-                                  'regex': '\"*ruby*\" \"*lib*ruby*\" \"*Ruby.framework*\"  \"*libssl*\"'}
+                                  'patterns': ['*ruby*', '*lib*ruby*', '*Ruby.framework*', '*libssl*']}
                        }
         elif isElCap:
             # In ElCap pretty much everything is in Essentials.
             # We also need to add libssl as it's no longer standard.
             payloads = { 'python': {'sourcepayloads': ['Essentials'],
-                                    'regex': '\"*Py*\" \"*py*\" \"*libssl*\"'},
+                                    'patterns': ['*Py*', '*py*', '*libssl*']},
                          'ruby': {'sourcepayloads': ['Essentials'],
-                                  'regex': '\"*ruby*\" \"*lib*ruby*\" \"*Ruby.framework*\"  \"*libssl*\"'}
+                                  'patterns': ['*ruby*', '*lib*ruby*', '*Ruby.framework*', '*libssl*']}
                        }
         else:
             payloads = { 'python': {'sourcepayloads': ['BSD'],
-                                    'regex': '\"*Py*\" \"*py*\"'},
+                                    'patterns': ['*Py*', '*py*']},
                          'ruby': {'sourcepayloads': ['BSD', 'Essentials'],
-                                  'regex': '\"*ruby*\" \"*lib*ruby*\" \"*Ruby.framework*\"'}
+                                  'patterns': ['*ruby*', '*lib*ruby*', '*Ruby.framework*']}
                        }
+        # Work out which payloads the frameworks need and gather up the cpio
+        #   glob patterns for each one, so a payload shared between
+        #   frameworks only gets read and unpacked once
+        payloadpatterns = {}
+        for framework in addframeworks:
+            frameworkpatterns = payloads[framework]['patterns']
+            for payload in payloads[framework]['sourcepayloads']:
+                patterns = payloadpatterns.setdefault(payload, [])
+                for pattern in frameworkpatterns:
+                    if pattern not in patterns:
+                        patterns.append(pattern)
+
+        # With the lzma module or xz around every payload is streamed
+        #   straight from its package into cpio further down. Without either
+        #   we need them on disk to decompress. Fetching only touches TMPDIR,
+        #   so start it now in the background, in parallel since the payloads
+        #   don't depend on each other, and let it overlap with getting
+        #   BaseSystem.dmg ready below. fetched maps each payload to the
+        #   future for its cached archive.
+        fetched = {}
+        if payloadpatterns and lzma is None and XZEXEC is None:
+            payloadsneeded = sorted(payloadpatterns)
+            print("-------------------------------------------------------------------------")
+            print("Fetching payloads %s from %s" % (', '.join(payloadsneeded), installersource))
+            fetchpool = ThreadPoolExecutor(min(len(payloadsneeded), cpu_count()))
+            for payload in payloadsneeded:
+                fetched[payload] = fetchpool.submit(self.fetchpayload, installersource, payload)
+            # Don't wait here, the futures are collected when they're needed
+            fetchpool.shutdown(wait=False)
+
         # Set 'modifybasesystem' if any frameworks are to be added, we're building
         #   an ElCap NBI or if we're adding a custom Utilites plist
         modifybasesystem = (len(addframeworks) > 0 or isElCap or isSierra or isHighSierra or self.utilplist)
@@ -854,19 +1494,9 @@ class processNBI(object):
                 basesystemdmg = os.path.join(nbimount, 'Install macOS High Sierra.app/Contents/SharedSupport/BaseSystem.dmg')
 
             print("Running self.dmgresize...")
-            result = self.runcmd(self.dmgresize(basesystemdmg, basesystemshadow, '8G'))
-            print("Running self.dmgattach...")
-            plist = self.runcmd(self.dmgattach(basesystemdmg, basesystemshadow))
-
-            # print("Contents of plist:\n------\n%s\n------" % plist)
-
-            basesystemplist = plistlib.readPlistFromString(plist)
-
-            # print("Contents of basesystemplist:\n------\n%s\n------" % basesystemplist)
-
-            for entity in basesystemplist['system-entities']:
-                if 'mount-point' in entity:
-                    basesystemmountpoint = entity['mount-point']
+            self.runcmd(self.dmgresize(basesystemdmg, basesystemshadow, '8G'), capture_output=False)
+            print("Running self.attach...")
+            basesystemmountpoint = self.attach(basesystemdmg, basesystemshadow)
 
         # OS X 10.11 El Capitan triggers an Installer Progress app which causes
         #   custom installer workflows using 'Packages/Extras' to fail so
@@ -902,7 +1532,7 @@ class processNBI(object):
             rcdotinstallro.close()
             rcdotinstallw = open(rcdotinstallpath, "w")
             for line in rcdotinstalllines:
-                if line.rstrip() != "/System/Library/CoreServices/Installer\ Progress.app/Contents/MacOS/Installer\ Progress &":
+                if line.rstrip() != r"/System/Library/CoreServices/Installer\ Progress.app/Contents/MacOS/Installer\ Progress &":
                     rcdotinstallw.write(line)
             rcdotinstallw.close()
 
@@ -924,7 +1554,7 @@ class processNBI(object):
         # Handle any custom content to be added, customfolder has a value
         if self.customfolder:
             print("-------------------------------------------------------------------------")
-            print "Modifying NetBoot volume at %s" % nbimount
+            print("Modifying NetBoot volume at %s" % nbimount)
 
             # Sets up which directory to process. This is a simple version until
             # we implement something more full-fledged, based on a config file
@@ -934,14 +1564,13 @@ class processNBI(object):
             if isHighSierra:
                 processdir = os.path.join(basesystemmountpoint, 'System/Installation', ''.join(self.customfolder.split('/')[-1:]))
 
-            # Remove folder being modified - distutils appears to have the easiest
-            # method to recursively delete a folder. Same with recursively copying
-            # back its replacement.
+            # Remove folder being modified, then recursively copy back its
+            # replacement.
             print('About to process ' + processdir + ' for replacement...')
             if os.path.lexists(processdir):
-                if os.path.isdir(processdir):
+                if os.path.isdir(processdir) and not os.path.islink(processdir):
                     print('Removing directory %s' % processdir)
-                    distutils.dir_util.remove_tree(processdir)
+                    shutil.rmtree(processdir)
                 # This may be a symlink or other non-dir instead, so double-tap just in case
                 else:
                     print('Removing file or symlink %s' % processdir)
@@ -951,7 +1580,7 @@ class processNBI(object):
             # we can skip the above removal and get straight to copying.
             # os.mkdir(processdir)
             print('Copying ' + self.customfolder + ' to ' + processdir + '...')
-            distutils.dir_util.copy_tree(self.customfolder, processdir)
+            copytree(self.customfolder, processdir)
             print('Done copying ' + self.customfolder + ' to ' + processdir + '...')
 
             # High Sierra 10.13 contains the InstallESD.dmg as part of the installer app, remove it to free up space
@@ -962,61 +1591,39 @@ class processNBI(object):
         # Is Python or Ruby being added? If so, do the work.
         if addframeworks:
 
-            # Create an empty list to record cached Payload resources
-            havepayload = []
-
-            # Loop through the frameworks we've been asked to include
             for framework in addframeworks:
-
-                # Get the cpio glob pattern/regex to extract the framework
-                regex = payloads[framework]['regex']
-                print("-------------------------------------------------------------------------")
                 print("Adding %s framework from %s to NBI at %s" % (framework.capitalize(), installersource, nbimount))
 
-                # Loop through all possible source payloads for this framework
-                for payload in payloads[framework]['sourcepayloads']:
-
-                    payloadsource = os.path.join(TMPDIR, 'Payload')
-                    # os.rename(payloadsource, payloadsource + '-' + payload)
-                    # payloadsource = payloadsource + '-' + payload
-                    cpio_archive = payloadsource + '-' + payload + '.cpio.xz'
-                    xar_source = os.path.join(installersource, 'Packages', payload + '.pkg')
-
-                    print("Cached payloads: %s" % havepayload)
-
-                    # Check whether we already have this Payload from a previous run
-                    if cpio_archive not in havepayload:
-
-                        print("-------------------------------------------------------------------------")
-                        print("No cache, extracting %s" % xar_source)
-
-                        # Extract Payload(s) from desired OS X installer package
-                        sysplatform = sys.platform
-                        self.runcmd(self.xarextract(xar_source, sysplatform))
-
-                        # Determine the Payload file type using 'file'
-                        payloadtype = self.runcmd(self.getfiletype(payloadsource)).split(': ')[1]
-
-                        print("Processing payloadsource %s" % payloadsource)
-                        result = self.processframeworkpayload(payloadsource, payloadtype, cpio_archive)
-
-                        # Log that we have this cpio_archive in case we need it later
-                        if cpio_archive not in havepayload:
-                            # print("Adding cpio_archive %s to havepayload" % cpio_archive)
-                            havepayload.append(cpio_archive)
-
-                    # Extract our needed framework bits from CPIO arch
-                    #   using shell globbing pattern(s)
-                    print("-------------------------------------------------------------------------")
-                    print("Processing cpio_archive %s" % cpio_archive)
-                    self.runcmd(self.cpioextract(cpio_archive, regex),
-                                cwd=basesystemmountpoint)
+            # Wait for the payloads fetched in the background above, if any.
+            #   havepayload maps each payload to its cached archive.
+            havepayload = dict((payload, future.result()) for payload, future in fetched.items())
 
-            for cpio_archive in havepayload:
+            # Extract our needed framework bits from each payload using shell
+            #   globbing patterns, one cpio run per payload. These all write
+            #   into the same BaseSystem so they run one at a time.
+            packagesdir = os.path.join(installersource, 'Packages')
+            for payload in sorted(payloadpatterns):
+                patterns = payloadpatterns[payload]
                 print("-------------------------------------------------------------------------")
-                print("Removing cached Payload %s" % cpio_archive)
-                if os.path.exists(cpio_archive):
-                    os.remove(cpio_archive)
+                if payload not in havepayload:
+                    xar_source = os.path.join(packagesdir, payload + '.pkg')
+                    self.streampayload(xar_source, patterns, basesystemmountpoint)
+                    continue
+
+                cpio_archive = havepayload[payload]
+                print("Processing cpio_archive %s" % cpio_archive)
+                self.runcmd(self.cpioextract(cpio_archive, patterns),
+                            cwd=basesystemmountpoint, capture_output=False)
+
+            # Nothing needs the cached payloads anymore, remove them in the
+            #   background instead of holding up the BaseSystem steps below.
+            #   close() waits for this to finish.
+            if havepayload:
+                print("-------------------------------------------------------------------------")
+                print("Removing cached Payloads %s" % ', '.join(havepayload.values()))
+                remover = threading.Thread(target=removefiles, args=(list(havepayload.values()),))
+                remover.start()
+                self.workers.append(remover)
 
         # Add custom Utilities.plist if passed as an argument
         if self.utilplist:
@@ -1027,30 +1634,29 @@ class processNBI(object):
                                 'System/Installation/CDIS/OS X Utilities.app/Contents/Resources/Utilities.plist'))
             except:
                 print("Failed to add custom Utilites plist from %s" % self.utilplist)
+                self.failed = True
 
         if modifybasesystem and basesystemmountpoint:
 
             # Done adding frameworks to BaseSystem, unmount and convert
             # detachresult = self.runcmd(self.dmgdetach(basesystemmountpoint))
-            detachresult = unmountdmg(basesystemmountpoint)
+            unmountdmg(basesystemmountpoint)
 
             # Set some DMG conversion targets for later
             basesystemrw = os.path.join(TMPDIR, 'BaseSystemRW.dmg')
-            basesystemro = os.path.join(TMPDIR, 'BaseSystemRO.dmg')
 
             # Convert to UDRW, the only format that will allow resizing the BaseSystem.dmg later
-            convertresult = self.runcmd(self.dmgconvert(basesystemdmg, basesystemrw, basesystemshadow, 'UDRW'))
+            self.runcmd(self.dmgconvert(basesystemdmg, basesystemrw, basesystemshadow, 'UDRW'), capture_output=False)
             # Delete the original DMG, we need to clear up some space where possible
             os.remove(basesystemdmg)
 
             # Resize BaseSystem.dmg to its smallest possible size (using hdiutil resize -limits)
-            resizeresult = self.runcmd(self.dmgresize(basesystemrw))
-
-            # Convert again, to UDRO, to shrink the final DMG size more
-            convertresult = self.runcmd(self.dmgconvert(basesystemrw, basesystemro, None, 'UDRO'))
+            self.runcmd(self.dmgresize(basesystemrw), capture_output=False)
 
-            # Rename the finalized DMG to its intended name BaseSystem.dmg
-            shutil.copyfile(basesystemro, basesystemdmg)
+            # Convert again, to UDRO, to shrink the final DMG size more. Write
+            #   it straight to BaseSystem.dmg's old spot in the NBI rather than
+            #   to TMPDIR, saving a copy of the whole image.
+            self.runcmd(self.dmgconvert(basesystemrw, basesystemdmg, None, 'UDRO'), capture_output=False)
 
             # For High Sierra, remove the chunklists for InstallESD and BaseSystem since they won't match
             # This includes removing chunklist entry from InstallInfo.plist
@@ -1062,166 +1668,193 @@ class processNBI(object):
 
                 installinfofile = os.path.join(nbimount, 'Install macOS High Sierra.app/Contents/SharedSupport/InstallInfo.plist')
                 if os.path.exists(installinfofile):
-                    installinfoplist = plistlib.readPlist(installinfofile)
+                    installinfoplist = readplist(installinfofile)
                     if 'System Image Info' in installinfoplist:
                         if installinfoplist['System Image Info'].get('chunklistid'):
                             del installinfoplist['System Image Info']['chunklistid']
                         if installinfoplist['System Image Info'].get('chunklistURL'):
                             del installinfoplist['System Image Info']['chunklistURL']
-                        plistlib.writePlist(installinfoplist, os.path.join(nbimount, 'Install macOS High Sierra.app/Contents/SharedSupport/InstallInfo.plist'))
+                        writeplist(installinfoplist, os.path.join(nbimount, 'Install macOS High Sierra.app/Contents/SharedSupport/InstallInfo.plist'))
 
         # We're done, unmount the outer NBI DMG.
         unmountdmg(nbimount)
 
         # Convert modified DMG to .sparseimage, this will shrink the image
-        # automatically after modification.
+        # automatically after modification. The conversion takes a while,
+        # let it run in the background while the caller cleans up and
+        # finish it off in close().
         print("-------------------------------------------------------------------------")
-        print "Sealing DMG at path %s" % (dmgpath)
-        dmgfinal = convertdmg(dmgpath, nbishadow)
-        # print('Got back final DMG as ' + dmgfinal + ' from convertdmg()...')
-
-        # Do some cleanup, remove original DMG, its shadow file and rename
-        # .sparseimage to NetInstall.dmg
-        os.remove(nbishadow)
-        os.remove(dmgpath)
-        os.rename(dmgfinal, dmgpath)
+        print("Sealing DMG at path %s" % (dmgpath))
+        if nbishadow:
+            convertproc, dmgfinal = convertdmg(dmgpath, nbishadow)
+            # print('Got back final DMG as ' + dmgfinal + ' from convertdmg()...')
+        else:
+            # Modified in place, it's already a sparse image
+            convertproc, dmgfinal = compactdmg(dmgpath), None
+        self.pending.append((convertproc, dmgpath, nbishadow, dmgfinal))
+
+    # Waits for the conversions and cleanup started by processNBI.modify()
+    #   and puts the finished DMGs in place
+    def close(self):
+        while self.workers:
+            self.workers.pop(0).join()
+        while self.pending:
+            convertproc, dmgpath, nbishadow, dmgfinal = self.pending.pop(0)
+            print("Waiting for DMG at path %s to be sealed..." % dmgpath)
+            if waitconvert(convertproc):
+                # Leave the original DMG and its shadow file alone
+                self.failed = True
+                continue
+            if not nbishadow:
+                continue
+
+            # Do some cleanup, remove original DMG, its shadow file and rename
+            # .sparseimage to NetInstall.dmg
+            os.remove(nbishadow)
+            os.remove(dmgpath)
+            os.rename(dmgfinal, dmgpath)
 
 
 TMPDIR = None
+RAMDISK = None
 sysidenabled = []
-isElCap = False
-isSierra = False
-isHighSierra = False
 
-if LooseVersion(_get_mac_ver()) >= "10.13":
-    BUILDEXECPATH = ('/System/Library/PrivateFrameworks/SIUFoundation.framework/XPCServices/com.apple.SIUAgent.xpc/Contents/Resources')
-    isHighSierra = True
-elif LooseVersion(_get_mac_ver()) >= "10.12":
-    BUILDEXECPATH = ('/System/Library/PrivateFrameworks/SIUFoundation.framework/XPCServices/com.apple.SIUAgent.xpc/Contents/Resources')
-    isSierra = True
-elif LooseVersion(_get_mac_ver()) >= "10.11":
+# Work out the host OS version once, everything below and the OS checks
+#   throughout compare against these
+MACVER = versiontuple(_get_mac_ver())
+isHighSierra = MACVER >= (10, 13)
+isSierra = (10, 12) <= MACVER < (10, 13)
+isElCap = (10, 11) <= MACVER < (10, 12)
+
+if MACVER >= (10, 11):
     BUILDEXECPATH = ('/System/Library/PrivateFrameworks/SIUFoundation.framework/XPCServices/com.apple.SIUAgent.xpc/Contents/Resources')
-    isElCap = True
-elif LooseVersion(_get_mac_ver()) < "10.10":
+elif MACVER < (10, 10):
     BUILDEXECPATH = ('/System/Library/CoreServices/System Image Utility.app/Contents/Frameworks/SIUFoundation.framework/'
                  'Versions/A/XPCServices/com.apple.SIUAgent.xpc/Contents/Resources')
 else:
     BUILDEXECPATH = ('/System/Library/CoreServices/Applications/System Image Utility.app/Contents/Frameworks/SIUFoundation.framework/'
                  'Versions/A/XPCServices/com.apple.SIUAgent.xpc/Contents/Resources')
 
+# The command line parser only needs building once, do that at import time
+#   instead of on every call to main()
+PARSER = argparse.ArgumentParser(
+    usage='%(prog)s --source/-s <path>\n'
+          '                   --name/-n MyNBI\n'
+          '                   [--destination/-d] <path>\n'
+          '                   [--folder/-f] FolderName\n'
+          '                   [--auto/-a]\n'
+          '                   [--enable/-e]\n'
+          '                   [--default]\n'
+          '                   [--index]\n'
+          '                   [--sysid-enable]\n'
+          '                   [--type]\n'
+          '                   [--add-python/-p]\n'
+          '                   [--add-ruby/-r]\n'
+          '                   [--utilities-plist]\n'
+          '                   [--ramdisk GB]\n'
+          '                   [--no-cache]',
+    description='%(prog)s creates an OS X 10.7, 10.8, 10.9, 10.10, 10.11 or 10.12\n'
+                'NetInstall NBI ready for use with a NetBoot server.\n\n'
+                'The NBI target OS X version must match that of the host OS.\n\n'
+                'An option to modify the NBI\'s NetInstall.dmg is also provided\n'
+                'by specifying an optional name of a folder in the source root\n'
+                'to add or replace on the NetInstall.dmg.',
+    epilog='Examples:\n'
+           'Run interactively, pick OS X installer from /Applications:\n'
+           '$ ./AutoNBI.py -s /Applications -d ~/BuildRoot -n MyNBI\n\n'
+           'Run non-interactively, use Mavericks installer app as source:\n'
+           '$ ./AutoNBI.py -s /Volumes/Disk/Install OS X Mavericks.app -d'
+           ' ~/BuildRoot -n MyNBI -a\n\n'
+           'Run non-interactively, use an InstallESD.dmg file as source\n'
+           'and replace the Packages folder on the resulting NBI:\n'
+           '$ ./AutoNBI.py -s ~/Documents/InstallESD.dmg -d ~/BuildRoot -n MyNBI'
+           ' -f Packages -a\n\n'
+           'Run non-interactively, use the Yosemite installer as source,\n'
+           'replace Packages folder, enable the NBI, use index 6667 and\n'
+           'enable support for MacBookPro12,1 models only:\n'
+           '$ ./AutoNBI.py --source /Applications/Install\\ OS\\ X\\ Yosemite.app \\\n'
+           '               --destination /tmp \\\n'
+           '               --name Imagr \\\n'
+           '               --folder Packages \\\n'
+           '               --auto --default --enable \\\n'
+           '               --index 6667 \\\n'
+           '               --sysid-enable MacBookPro12,1',
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+# Setup the recognized options
+PARSER.add_argument('--source', '-s',
+                    help='Required. Path to Install Mac OS X Lion.app '
+                         'or Install OS X Mountain Lion.app or Install OS X Mavericks.app')
+PARSER.add_argument('--name', '-n',
+                    help='Required. Name of the NBI, also applies to .plist')
+PARSER.add_argument('--destination', '-d',
+                    help='Optional. Path to save .plist and .nbi files. Defaults to CWD.')
+PARSER.add_argument('--folder', '-f', default='',
+                    help='Optional. Name of a folder on the NBI to modify. This will be the '
+                         'root below which changes will be made')
+PARSER.add_argument('--auto', '-a', action='store_true',
+                    help='Optional. Toggles automation mode, suitable for scripted runs')
+PARSER.add_argument('--enable-nbi', '-e', action='store_true', dest='enablenbi',
+                    help='Optional. Marks NBI as enabled (IsEnabled = True).')
+PARSER.add_argument('--add-ruby', '-r', action='store_true', dest='addruby',
+                    help='Optional. Enables Ruby in BaseSystem.')
+PARSER.add_argument('--add-python', '-p', action='store_true', dest='addpython',
+                    help='Optional. Enables Python in BaseSystem.')
+PARSER.add_argument('--utilities-plist', action='store_true', dest='utilplist',
+                    help='Optional. Add a custom Utilities.plist to modify the menu.')
+PARSER.add_argument('--default', action='store_true', dest='isdefault',
+                    help='Optional. Marks the NBI as the default for all clients. Only one default should be '
+                         'enabled on any given NetBoot/NetInstall server.')
+PARSER.add_argument('--index', default=5000, dest='nbiindex', type=int,
+                    help='Optional. Set a custom Index for the NBI. Default is 5000.')
+PARSER.add_argument('--type', default='NFS', dest='nbitype',
+                    help='Optional. Set a custom Type for the NBI. HTTP or NFS. Default is NFS.')
+PARSER.add_argument('--sysid-enable', dest='sysidenabled', action='append',
+                    help='Optional. Whitelist a given System ID (\'MacBookPro10,1\') Can be '
+                         'defined multiple times. WARNING: This will enable ONLY the listed '
+                         'System IDs. Systems not explicitly marked as enabled will not be '
+                         'able to boot from this NBI.')
+PARSER.add_argument('--ramdisk', dest='ramdisk', type=int, metavar='GB',
+                    help='Optional. Keep temporary files on a RAM disk of this many GB instead '
+                         'of the startup disk. It needs to hold the extracted payloads and '
+                         'BaseSystem.dmg while it is being modified, so make sure there is '
+                         'enough free memory.')
+PARSER.add_argument('--no-cache', action='store_true', dest='nocache',
+                    help='Optional. Build the NBI even if the one at the destination was '
+                         'already built from the same source with the same options.')
+
 def main():
     """Main routine"""
 
     global TMPDIR
+    global RAMDISK
     global sysidenabled
 
-    # TBD - Full usage text
-    usage = ('Usage: %prog --source/-s <path>\n'
-             '                   --name/-n MyNBI\n'
-             '                   [--destination/-d] <path>\n'
-             '                   [--folder/-f] FolderName\n'
-             '                   [--auto/-a]\n'
-             '                   [--enable/-e]\n'
-             '                   [--default]\n'
-             '                   [--index]\n'
-             '                   [--sysid-enable]\n'
-             '                   [--type]\n'
-             '                   [--add-python/-p]\n'
-             '                   [--add-ruby/-r]\n'
-             '                   [--utilities-plist]\n\n'
-             '    %prog creates an OS X 10.7, 10.8, 10.9, 10.10, 10.11 or 10.12\n'
-             '    NetInstall NBI ready for use with a NetBoot server.\n\n'
-             '    The NBI target OS X version must match that of the host OS.\n\n'
-             '    An option to modify the NBI\'s NetInstall.dmg is also provided\n'
-             '    by specifying an optional name of a folder in the source root\n'
-             '    to add or replace on the NetInstall.dmg.\n\n'
-             '    Examples:\n'
-             '    Run interactively, pick OS X installer from /Applications:\n'
-             '    $ ./AutoNBI.py -s /Applications -d ~/BuildRoot -n MyNBI\n\n'
-             '    Run non-interactively, use Mavericks installer app as source:\n'
-             '    $ ./AutoNBI.py -s /Volumes/Disk/Install OS X Mavericks.app -d'
-             ' ~/BuildRoot -n MyNBI -a\n\n'
-             '    Run non-interactively, use an InstallESD.dmg file as source\n'
-             '    and replace the Packages folder on the resulting NBI:\n'
-             '    $ ./AutoNBI.py -s ~/Documents/InstallESD.dmg -d ~/BuildRoot -n MyNBI'
-             ' -f Packages -a\n\n'
-             '    Run non-interactively, use the Yosemite installer as source,\n'
-             '    replace Packages folder, enable the NBI, use index 6667 and\n'
-             '    enable support for MacBookPro12,1 models only:\n'
-             '    $ ./AutoNBI.py --source /Applications/Install\ OS\ X\ Yosemite.app\n'
-             '                   --destination /tmp \\\n'
-             '                   --name Imagr \\\n'
-             '                   --folder Packages \\\n'
-             '                   --auto --default --enable \\\n'
-             '                   --index 6667 \\\n'
-             '                   --sysid-enable MacBookPro12,1')
-
-    # Setup a parser instance
-    parser = optparse.OptionParser(usage=usage)
-
-    # Setup the recognized options
-    parser.add_option('--source', '-s',
-                      help='Required. Path to Install Mac OS X Lion.app '
-                           'or Install OS X Mountain Lion.app or Install OS X Mavericks.app')
-    parser.add_option('--name', '-n',
-                      help='Required. Name of the NBI, also applies to .plist')
-    parser.add_option('--destination', '-d', default=os.getcwd(),
-                      help='Optional. Path to save .plist and .nbi files. Defaults to CWD.')
-    parser.add_option('--folder', '-f', default='',
-                      help='Optional. Name of a folder on the NBI to modify. This will be the\
-                            root below which changes will be made')
-    parser.add_option('--auto', '-a', action='store_true', default=False,
-                      help='Optional. Toggles automation mode, suitable for scripted runs')
-    parser.add_option('--enable-nbi', '-e', action='store_true', default=False,
-                      help='Optional. Marks NBI as enabled (IsEnabled = True).', dest='enablenbi')
-    parser.add_option('--add-ruby', '-r', action='store_true', default=False,
-                      help='Optional. Enables Ruby in BaseSystem.', dest='addruby')
-    parser.add_option('--add-python', '-p', action='store_true', default=False,
-                      help='Optional. Enables Python in BaseSystem.', dest='addpython')
-    parser.add_option('--utilities-plist', action='store_true', default=False,
-                      help='Optional. Add a custom Utilities.plist to modify the menu.', dest='utilplist')
-    parser.add_option('--default', action='store_true', default=False,
-                      help='Optional. Marks the NBI as the default for all clients. Only one default should be '
-                           'enabled on any given NetBoot/NetInstall server.', dest='isdefault')
-    parser.add_option('--index', default=5000, dest='nbiindex', type='int',
-                      help='Optional. Set a custom Index for the NBI. Default is 5000.')
-    parser.add_option('--type', default='NFS', dest='nbitype',
-                      help='Optional. Set a custom Type for the NBI. HTTP or NFS. Default is NFS.')
-    parser.add_option('--sysid-enable', dest='sysidenabled', action='append', type='str',
-                      help='Optional. Whitelist a given System ID (\'MacBookPro10,1\') Can be '
-                           'defined multiple times. WARNING: This will enable ONLY the listed '
-                           'System IDs. Systems not explicitly marked as enabled will not be '
-                           'able to boot from this NBI.')
-
     # Parse the provided options
-    options, arguments = parser.parse_args()
-
-    # Check our passed options, at least source, destination and name are required
-    if options is None:
-        parser.print_help()
-        sys.exit(-1)
+    options = PARSER.parse_args()
 
+    # Check our passed options, at least source and name are required
     if not options.source:
-        parser.error('Missing --source flag, stopping.')
+        PARSER.error('Missing --source flag, stopping.')
     if not options.name:
-        parser.error('Missing --name flag, stopping.')
+        PARSER.error('Missing --name flag, stopping.')
 
     # Get the root path now, we need to test and bail if it's not found soon.
     root = options.source
 
     # Are we root?
     if os.getuid() != 0:
-        parser.print_usage()
-        print >> sys.stderr, 'This tool requires sudo or root privileges.'
-        exit(-1)
+        PARSER.print_usage()
+        print('This tool requires sudo or root privileges.', file=sys.stderr)
+        sys.exit(-1)
 
     if not os.path.exists(root):
-        print >> sys.stderr, 'The given source at %s does not exist.' % root
-        exit(-1)
+        print('The given source at %s does not exist.' % root, file=sys.stderr)
+        sys.exit(-1)
 
     # Setup our base requirements for installer app root path, destination,
     #   name of the NBI and auto mode.
-    destination = options.destination
+    destination = options.destination or os.getcwd()
     auto = options.auto
     enablenbi = options.enablenbi
     customfolder = options.folder
@@ -1240,18 +1873,15 @@ def main():
     addcustom = len(customfolder) > 0
     modifynbi = (addcustom or addpython or addruby or isElCap or isSierra or isHighSierra)
 
-    # Spin up a tmp dir for mounting
-    TMPDIR = tempfile.mkdtemp(dir=TMPDIR)
-
     # Now we start a typical run of the tool, first locate one or more
     #   installer app candidates
 
     if os.path.isdir(root):
-        print 'Locating installer...'
+        print('Locating installer...')
         source = locateinstaller(root, auto)
         shouldcreatenbi = True
-    elif mimetypes.guess_type(root)[0].endswith('diskimage'):
-        print 'Source is a disk image.'
+    elif isdiskimage(root):
+        print('Source is a disk image.')
         if 'NetInstall' in root:
             print('Disk image is an existing NetInstall, will modify only...')
             shouldcreatenbi = False
@@ -1261,7 +1891,7 @@ def main():
         source = root
 
     else:
-        print 'Source is neither an installer app or InstallESD.dmg.'
+        print('Source is neither an installer app or InstallESD.dmg.')
         sys.exit(-1)
 
     if shouldcreatenbi:
@@ -1274,45 +1904,91 @@ def main():
         if type(source) == list:
             source = pickinstaller(source)
 
+        # Skip the whole build if the NBI at the destination was already
+        #   made from this source with these options. The fingerprint is
+        #   only written once a build completes, so a failed or interrupted
+        #   one never matches. --no-cache builds don't fingerprint at all.
+        nbipath = os.path.join(destination, name + '.nbi')
+        fingerprint = None
+        if not options.nocache:
+            fingerprint = buildfingerprint(source,
+                                           (name, enablenbi, isdefault, nbiindex, nbitype, sysidenabled,
+                                            addpython, addruby, utilplist, MACVER),
+                                           os.path.abspath(customfolder) if addcustom else None)
+            if readfingerprint(nbipath) == fingerprint:
+                print('%s was already built from %s with these options, skipping. '
+                      'Use --no-cache to rebuild it.' % (nbipath, source))
+                return
+        if os.path.isdir(nbipath):
+            writefingerprint(nbipath, None)
+
+    # Spin up a tmp dir for mounting, on a RAM disk if asked to. Only now
+    #   that we know there's work to do, a skipped build needs neither.
+    TMPDIR = tempfile.mkdtemp(dir=TMPDIR)
+    # However we leave, don't leave TMPDIR or anything mounted in it behind.
+    #   The normal paths below clean up early, doing it again is harmless.
+    atexit.register(cleanUp)
+    if options.ramdisk:
+        print('Creating %s GB RAM disk at %s' % (options.ramdisk, TMPDIR))
+        RAMDISK = createramdisk(options.ramdisk, TMPDIR)
+
+    if shouldcreatenbi:
         # Prep the build root - create it if it's not there
         if not os.path.exists(destination):
             os.mkdir(destination)
 
+        # Reading the OS version usually means mounting a BaseSystem.dmg,
+        #   run that in the background while we get on with the rest. On
+        #   10.13+ it's read from the installer app rather than the source,
+        #   so it doesn't even need to wait for the source mount.
+        versionpool = ThreadPoolExecutor(1)
+        versioninfo = None
+        if isHighSierra:
+            versioninfo = versionpool.submit(getosversioninfo, os.path.join(root, 'Contents/SharedSupport'))
+
         if source.endswith('dmg'):
             # Mount our installer source DMG
-            print 'Mounting ' + source
-            mountpoints = mountdmg(source)
-
-            # Get the mount point for the DMG
-            if len(mountpoints) > 1:
-                for i in mountpoints[0]:
-                    if i.find('dmg'):
-                        mount = i
-            else:
-                mount = mountpoints[0]
+            print('Mounting ' + source)
+            mountpoints, unused = mountdmg(source, readonly=True)
+            if not mountpoints:
+                # Let a running version check finish before cleaning up
+                versionpool.shutdown()
+                fail('Unable to mount %s.' % source)
+
+            # Get the mount point for the DMG, the volume we're after is the
+            #   last entity with a mount point
+            mount = mountpoints[-1]
         elif source.endswith('com.apple.recovery.boot'):
             mount = source
         else:
-            print 'Install source is neither InstallESD nor Recovery drive, this is bad.'
+            print('Install source is neither InstallESD nor Recovery drive, this is bad.')
+            versionpool.shutdown()
             sys.exit(-1)
 
-        if not isHighSierra:
-            osversion, osbuild, unused = getosversioninfo(mount)
-        else:
-            osversion, osbuild, unused = getosversioninfo(os.path.join(root, 'Contents/SharedSupport'))
+        if versioninfo is None:
+            versioninfo = versionpool.submit(getosversioninfo, mount)
+        versionpool.shutdown(wait=False)
+
+        # Prep our build root for NBI creation
+        print('Prepping ' + destination + ' with source mounted at ' + mount)
+        prepworkdir(destination)
+
+        # Errors reading the version surface here, on the main thread, so
+        #   cleaning up can't pull TMPDIR out from under work in progress.
+        #   fail() unmounts whatever is still mounted in there.
+        try:
+            osversion, osbuild, unused = versioninfo.result()
+        except Exception as err:
+            fail(str(err))
 
         if not isSierra or not isHighSierra:
             description = "OS X %s - %s" % (osversion, osbuild)
         else:
             description = "macOS %s - %s" % (osversion, osbuild)
 
-        # Prep our build root for NBI creation
-        print 'Prepping ' + destination + ' with source mounted at ' + mount
-        prepworkdir(destination)
-
         # Now move on to the actual NBI creation
-        print 'Creating NBI at ' + destination
-        print 'Base NBI Operating System is ' + osversion
+        print('Creating NBI at ' + destination)
+        print('Base NBI Operating System is ' + osversion)
         createnbi(destination, description, osversion, name, enablenbi, nbiindex, nbitype, isdefault, mount, root)
 
     # Make our modifications if any were provided from the CLI
@@ -1342,23 +2018,38 @@ def main():
 
         nbi.modify(nbimount, netinstallpath, nbishadow, mount)
 
-        # We're done, unmount all the things
+        # We're done, unmount all the things while the NBI is being sealed
         if shouldcreatenbi:
             unmountdmg(mount)
 
-        distutils.dir_util.remove_tree(TMPDIR)
+        # Let the background cleanup and sealing finish before TMPDIR and
+        #   the RAM disk behind it go away
+        nbi.close()
+
+        cleanUp()
+
+        # Only remember a build that went through without errors, so the
+        #   next run doesn't skip a broken NBI
+        if shouldcreatenbi and not nbi.failed:
+            writefingerprint(nbipath, fingerprint)
+        elif shouldcreatenbi:
+            print('Errors occurred while modifying %s, not marking it as up to date.' % nbipath,
+                  file=sys.stderr)
 
         print("-------------------------------------------------------------------------")
-        print 'Modifications complete...'
-        print 'Done.'
+        print('Modifications complete...')
+        print('Done.')
     else:
         # We're done, unmount all the things
         unmountdmg(mount)
-        distutils.dir_util.remove_tree(TMPDIR)
+        cleanUp()
+
+        if shouldcreatenbi:
+            writefingerprint(nbipath, fingerprint)
 
         print("-------------------------------------------------------------------------")
-        print 'No modifications will be made...'
-        print 'Done.'
+        print('No modifications will be made...')
+        print('Done.')
 
 if __name__ == '__main__':
     main()